@@ -5,6 +5,7 @@ from torchvision.transforms import transforms
 import numpy as np
 from typing import List, Dict, Tuple, Optional, Union
 from torch import Tensor
+from utilities import inference_autocast, to_channels_last
 
 class AdaptiveWeightCalculator:
     """自適應權重計算器"""
@@ -214,12 +215,15 @@ def feature_distance_new(output: Tensor,
         )
     ])
     
-    output = transform(output.to(config.model.device))
-    target = transform(target.to(config.model.device))
+    output = to_channels_last(transform(output.to(config.model.device)), config)
+    target = to_channels_last(transform(target.to(config.model.device)), config)
     
-    with torch.no_grad():
+    with torch.no_grad(), inference_autocast(config):
         inputs_features = FE(target)
         output_features = FE(output)
+    # distance math stays in float32
+    inputs_features = [f.float() for f in inputs_features]
+    output_features = [f.float() for f in output_features]
     
     out_size = config.data.image_size
     anomaly_map = torch.zeros(
@@ -0,0 +1,84 @@
+import json
+import os
+import pickle
+
+import torch
+from omegaconf import OmegaConf
+
+from sample import DA_generalized_steps, distilled_seq, my_generalized_steps
+from utilities import DiffusionSchedule
+
+
+class ExportedModels:
+    """
+    Inference building blocks from a directory written by export.py:
+    TorchScript UNet, VAE encoder / decoder and feature extractor, plus the
+    config and beta schedule. Needs torch and this repository's sampler
+    (sample.py and the modules it imports), not diffusers, timm or the
+    HuggingFace hub. The fitted KNN is kept as its raw state (`knn`, memory
+    bank and histogram edges) without a query path, so the artifact does not
+    select step sizes by itself: reconstruct takes (step_size, skip), and
+    validate's dynamic-step inference needs the caller to choose them.
+    """
+    def __init__(self, path, device='cpu'):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.config = OmegaConf.load(os.path.join(path, 'config.yaml'))
+        self.config.model.device = str(device)
+        self.device = torch.device(device)
+        self.latent_scale = self.manifest['latent_scale']
+
+        self.unet = self._load('unet')
+        self.vae_encoder = self._load('vae_encoder')
+        self.vae_decoder = self._load('vae_decoder')
+        self.feature_extractor = self._load('feature_extractor')
+
+        betas = torch.load(os.path.join(path, 'betas.pt'))
+        self.constants_dict = {'betas': betas.to(self.device), 'schedule': DiffusionSchedule(betas, self.device)}
+        self.knn = None
+        if os.path.exists(os.path.join(path, 'knn.pkl')):
+            with open(os.path.join(path, 'knn.pkl'), 'rb') as f:
+                self.knn = pickle.load(f)
+            # the memory bank is queried on the artifact's device
+            self.knn = {name: value.to(self.device) if isinstance(value, torch.Tensor) or callable(getattr(value, 'to', None)) else value
+                        for name, value in self.knn.items()}
+
+    def _load(self, name):
+        return torch.jit.load(os.path.join(self.path, f'{name}.pt'), map_location=self.device).eval()
+
+    @torch.no_grad()
+    def encode(self, images, sample=True):
+        mean, logvar = self.vae_encoder(images.to(self.device))
+        latent = mean + torch.exp(0.5 * logvar) * torch.randn_like(mean) if sample else mean
+        return latent * self.latent_scale
+
+    @torch.no_grad()
+    def decode(self, latents):
+        return self.vae_decoder(latents.to(self.device) / self.latent_scale)
+
+    @torch.no_grad()
+    def features(self, images):
+        return list(self.feature_extractor(images.to(self.device)))
+
+    @torch.no_grad()
+    def reconstruct(self, latents, step_size, skip):
+        """DDAD reverse process from the test latents, as reconstruct_bucket in validate"""
+        config = self.config
+        at = self.constants_dict['schedule'].alpha_bar(step_size)
+        if config.model.noise_sampling:
+            noisy_image = at.sqrt() * latents + (1 - at).sqrt() * torch.randn_like(latents)
+        else:
+            noisy_image = latents * at.sqrt() if config.model.downscale_first else latents
+        seq = distilled_seq(step_size, skip, getattr(config.model, 'distilled_rounds', 0))
+        if config.model.dynamic_steps:
+            reconstruction, _ = my_generalized_steps(latents, noisy_image, [seq] * latents.shape[0], self.unet, self.constants_dict['betas'], config,
+                                                     eta2=config.model.eta2, eta3=0, constants_dict=self.constants_dict, final_only=True)
+        else:
+            reconstruction, _ = DA_generalized_steps(latents, noisy_image, seq, self.unet, self.constants_dict['betas'], config,
+                                                     eta2=config.model.eta2, eta3=0, constants_dict=self.constants_dict, final_only=True)
+        return reconstruction
+
+
+def load_artifact(path, device='cpu'):
+    return ExportedModels(path, device)
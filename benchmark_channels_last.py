@@ -0,0 +1,82 @@
+import argparse
+import os
+import time
+
+import torch
+from diffusers import AutoencoderKL
+from omegaconf import OmegaConf
+
+from feature_extractor import build_feature_extractor
+from main import build_model
+from utilities import to_channels_last
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD channels_last benchmark')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--batch_size', type=int, default=None,
+                                help='images per call, defaults to data.batch_size')
+    cmdline_parser.add_argument('--iters', type=int, default=10, help='timed iterations per stage')
+    cmdline_parser.add_argument('--warmup', type=int, default=3, help='untimed iterations per stage')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def timeit(fn, iters, warmup, device):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(iters):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / iters * 1000
+
+
+def run(config, channels_last, batch_size, iters, warmup):
+    """Per-stage latency in ms; weights do not matter for timing, so no checkpoint is needed."""
+    config.model.channels_last = channels_last
+    device = torch.device(config.model.device)
+    torch.manual_seed(42)
+
+    unet = to_channels_last(build_model(config).to(device).eval(), config)
+    vae = to_channels_last(AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse").to(device).eval(), config)
+    fe = to_channels_last(build_feature_extractor(config, pretrained=False).to(device).eval(), config)
+
+    image = to_channels_last(torch.randn(batch_size, 3, config.data.image_size, config.data.image_size, device=device), config)
+    latent = to_channels_last(torch.randn(batch_size, config.data.imput_channel, config.model.latent_size, config.model.latent_size, device=device), config)
+    t = torch.full((batch_size,), config.model.test_trajectoy_steps // 2, device=device)
+
+    stages = {
+        'vae encode': lambda: vae.encode(image).latent_dist.sample(),
+        'unet step': lambda: unet(latent, t),
+        'vae decode': lambda: vae.decode(latent).sample,
+        'feature extractor': lambda: fe(image),
+    }
+    rows = {name: timeit(fn, iters, warmup, device) for name, fn in stages.items()}
+    del unet, vae, fe
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    return rows
+
+
+def main():
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+    batch_size = args.batch_size or config.data.batch_size
+    nchw = run(config, False, batch_size, args.iters, args.warmup)
+    nhwc = run(config, True, batch_size, args.iters, args.warmup)
+
+    print(f"\n=== channels_last benchmark ({config.model.device}, batch {batch_size}) ===")
+    print(f"{'stage':<20}{'NCHW ms':>10}{'NHWC ms':>10}{'speedup':>9}")
+    for name in nchw:
+        print(f"{name:<20}{nchw[name]:>10.2f}{nhwc[name]:>10.2f}{nchw[name] / nhwc[name]:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import os
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from loss import get_loss
+from main import build_model, constant
+from optimizer import build_optimizer
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD activation checkpointing report')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                                help='training batch sizes to try')
+    cmdline_parser.add_argument('--iters', type=int, default=5, help='timed optimizer steps per setting')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def run(config, checkpointing, batch_size, iters):
+    """
+    Peak memory and throughput of `iters` UNet training steps on random latents;
+    returns None when the batch does not fit
+    """
+    device = torch.device(config.model.device)
+    torch.manual_seed(42)
+    model = build_model(config).to(device).set_gradient_checkpointing(checkpointing)
+    model.train()
+    optimizer = build_optimizer(model, config)
+    constants_dict = constant(config)
+    shape = (batch_size, config.data.imput_channel, config.model.latent_size, config.model.latent_size)
+
+    def train_step():
+        x_0 = torch.randn(shape, device=device)
+        t = torch.randint(0, config.model.trajectory_steps, (batch_size,), device=device).long()
+        optimizer.zero_grad()
+        loss = get_loss(model, constants_dict, x_0, t, config)
+        loss.backward()
+        optimizer.step()
+
+    try:
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        train_step()  # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(iters):
+            train_step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        peak = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == 'cuda' else float('nan')
+        return {'peak_mb': peak, 'images_per_s': batch_size * iters / elapsed}
+    except torch.cuda.OutOfMemoryError:
+        return None
+    finally:
+        del model, optimizer
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def main():
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+
+    print(f"\n=== activation checkpointing ({config.model.device}) ===")
+    print(f"{'batch':>6}{'checkpointing':>15}{'peak MB':>10}{'img/s':>9}")
+    for batch_size in args.batch_sizes:
+        for checkpointing in (False, True):
+            row = run(config, checkpointing, batch_size, args.iters)
+            if row is None:
+                print(f"{batch_size:>6}{str(checkpointing):>15}{'OOM':>10}{'-':>9}")
+            else:
+                print(f"{batch_size:>6}{str(checkpointing):>15}{row['peak_mb']:>10.0f}{row['images_per_s']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import argparse
+import os
+import time
+from datetime import timedelta
+
+import torch
+from omegaconf import OmegaConf
+from torchmetrics import AUROC
+
+from main import constant, load_model
+from test import validate
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD precision check')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--dtypes', nargs='+', default=['float32', 'bfloat16'],
+                                help='inference dtypes to compare, the first one is the reference')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def run(config, dtype):
+    config.model.inference_dtype = dtype
+    torch.manual_seed(42)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    unet = load_model(config)
+    constants_dict = constant(config)
+
+    start = time.time()
+    results = validate(unet, constants_dict, config)
+    elapsed = time.time() - start
+
+    auroc = AUROC(task="binary")(torch.tensor(results['predictions']), torch.tensor(results['labels'])).item()
+    peak = torch.cuda.max_memory_allocated() / 1024 ** 2 if torch.cuda.is_available() else float('nan')
+    del unet
+    torch.cuda.empty_cache()
+    return {'dtype': dtype, 'auroc': auroc, 'time': elapsed, 'peak_mb': peak}
+
+
+def main():
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+    rows = [run(config, dtype) for dtype in args.dtypes]
+
+    reference = rows[0]
+    print("\n=== precision check ===")
+    print(f"{'dtype':<10}{'AUROC':>9}{'delta':>9}{'time':>16}{'speedup':>9}{'peak MB':>10}")
+    for row in rows:
+        print(f"{row['dtype']:<10}{row['auroc']:>9.4f}{row['auroc'] - reference['auroc']:>+9.4f}"
+              f"{str(timedelta(seconds=row['time'])):>16}{reference['time'] / row['time']:>9.2f}{row['peak_mb']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
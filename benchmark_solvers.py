@@ -0,0 +1,68 @@
+import argparse
+import os
+import time
+from datetime import timedelta
+
+import torch
+from omegaconf import OmegaConf
+from torchmetrics import AUROC
+
+from main import constant, load_model
+from test import validate
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD solver benchmark')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--solvers', nargs='+', default=['ddim', 'dpmsolver++'],
+                                help='solvers to compare')
+    cmdline_parser.add_argument('--num_steps', nargs='+', type=int, default=[10, 5, 3],
+                                help='reverse steps per trajectory')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def run(config, unet, solver, num_steps):
+    config.model.solver = solver
+    config.model.dynamic_num_steps = num_steps
+    config.model.skip = max(config.model.test_trajectoy_steps // num_steps, 1)
+    constants_dict = constant(config)
+
+    start = time.time()
+    results = validate(unet, constants_dict, config)
+    elapsed = time.time() - start
+
+    auroc = AUROC(task="binary")(torch.tensor(results['predictions']), torch.tensor(results['labels'])).item()
+    steps = torch.tensor(results['steps_used'], dtype=torch.float)
+    return {
+        'solver': solver,
+        'num_steps': num_steps,
+        'unet_evals': steps.mean().item(),
+        'latent_l1': results['latent_l1'],
+        'auroc': auroc,
+        'time': elapsed,
+    }
+
+
+def main():
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+    unet = load_model(config)
+
+    rows = []
+    for solver in args.solvers:
+        for num_steps in args.num_steps:
+            torch.manual_seed(42)
+            rows.append(run(config, unet, solver, num_steps))
+
+    print("\n=== solver benchmark ===")
+    print(f"{'solver':<14}{'steps':>6}{'UNet evals/img':>16}{'latent L1':>12}{'AUROC':>9}{'time':>16}")
+    for row in rows:
+        print(f"{row['solver']:<14}{row['num_steps']:>6}{row['unet_evals']:>16.2f}{row['latent_l1']:>12.4f}"
+              f"{row['auroc']:>9.4f}{str(timedelta(seconds=row['time'])):>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+GOOD = 'good'
+ANOMALOUS = 'anomalous'
+
+
+def latent_score(l1_latent):
+    """Image score of the latent stage: max of the color_distance map of each image"""
+    return l1_latent.flatten(1).amax(dim=1)
+
+
+def calibration_path(config, model_id, params):
+    """
+    Train latent scores of one checkpoint and sampler setting, stored next to
+    the KNN pickle
+    """
+    key = hashlib.sha256(json.dumps({'model': model_id, 'params': params}, sort_keys=True).encode()).hexdigest()
+    return os.path.join(os.getcwd(), config.model.checkpoint_dir, config.data.category, f"cascade_{key[:16]}.json")
+
+
+def load_calibration(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['train_scores']
+
+
+def save_calibration(path, scores):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'train_scores': list(scores)}, f)
+
+
+class LatentCascade:
+    """
+    Two-stage decision for validate. Stage one scores every image on its
+    latent L1 map alone; scores below `low` are decided good and above `high`
+    anomalous without decoding. Only images in between go on to stage two
+    (VAE decode and the feature comparison). Both thresholds come from the
+    latent scores of the train split, which holds good images only.
+    """
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.counts = {GOOD: 0, ANOMALOUS: 0, None: 0}
+
+    @classmethod
+    def calibrate(cls, train_scores, config):
+        """
+        low: the model.cascade_low_quantile quantile of the train scores,
+        high: the largest train score times model.cascade_high_margin
+        """
+        scores = np.asarray(train_scores, dtype=np.float64)
+        low = float(np.quantile(scores, config.model.cascade_low_quantile))
+        high = float(scores.max() * config.model.cascade_high_margin)
+        print(f"cascade thresholds from {len(scores)} train images: low {low:.4f}, high {high:.4f}")
+        return cls(low, high)
+
+    def decide(self, scores):
+        """GOOD, ANOMALOUS or None (needs stage two) per score"""
+        decisions = []
+        for score in torch.as_tensor(scores).tolist():
+            decision = GOOD if score < self.low else ANOMALOUS if score > self.high else None
+            self.counts[decision] += 1
+            decisions.append(decision)
+        return decisions
+
+    def pass_through(self):
+        total = max(sum(self.counts.values()), 1)
+        return {
+            'latent': 1.0,
+            'decided_good': self.counts[GOOD] / total,
+            'decided_anomalous': self.counts[ANOMALOUS] / total,
+            'feature': self.counts[None] / total,
+        }
+
+    def report(self, calibration_seconds=None):
+        rates = self.pass_through()
+        if calibration_seconds is not None:
+            rates['calibration_seconds'] = calibration_seconds
+        print(f"cascade pass-through: latent stage {rates['latent']:.1%} -> decided good {rates['decided_good']:.1%}, "
+              f"decided anomalous {rates['decided_anomalous']:.1%}, feature stage {rates['feature']:.1%}")
+        return rates
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+
+from latent_cache import CachedLatentDistribution
+from utilities import blend_window, tile_positions
+
+# rough float32 activation footprint of the sd VAE per image pixel (peak of the
+# full resolution blocks); reduced precision stays below it
+ENCODE_BYTES_PER_PIXEL = 2048
+DECODE_BYTES_PER_PIXEL = 4096
+LATENT_FACTOR = 8
+
+
+def activation_bytes(height, width, bytes_per_pixel):
+    """Estimated peak memory of one height x width image, incl. the mid block attention at 1/8 resolution"""
+    tokens = height * width // LATENT_FACTOR ** 2
+    return height * width * bytes_per_pixel + tokens * tokens * 4
+
+
+class ChunkedVAE(nn.Module):
+    """
+    AutoencoderKL whose encode / decode stay within a memory budget. Inputs
+    are split along the batch into as few chunks as the budget allows; when a
+    single image does not fit, it is cut into overlapping square tiles (run in
+    batches as well) that are blended back with linear ramps. Returns the same
+    .latent_dist / .sample outputs as the wrapped VAE, so the UNet keeps
+    seeing the whole batch.
+    """
+    def __init__(self, vae, budget_mb, tile_overlap=64):
+        super().__init__()
+        self.vae = vae
+        self.budget = int(budget_mb * 2 ** 20)
+        self.tile_overlap = tile_overlap
+
+    def plan(self, height, width, bytes_per_pixel):
+        """(images or tiles per chunk, tile size in pixels or None for whole images)"""
+        per_image = activation_bytes(height, width, bytes_per_pixel)
+        if per_image <= self.budget:
+            return max(1, self.budget // per_image), None
+        tile = max(64, min(height, width) // 64 * 64)
+        while tile > 64 and activation_bytes(tile, tile, bytes_per_pixel) > self.budget:
+            tile -= 64
+        return max(1, self.budget // activation_bytes(tile, tile, bytes_per_pixel)), tile
+
+    def encode(self, x):
+        chunk, tile = self.plan(x.shape[-2], x.shape[-1], ENCODE_BYTES_PER_PIXEL)
+        if tile is None:
+            if chunk >= x.shape[0]:
+                return self.vae.encode(x)
+            moments = torch.cat([self._moments(part) for part in x.split(chunk)], dim=0)
+        else:
+            moments = self._tiled(x, self._moments, tile, self._overlap(tile), chunk, 1 / LATENT_FACTOR)
+        mean, logvar = moments.chunk(2, dim=1)
+        return SimpleNamespace(latent_dist=CachedLatentDistribution(mean, logvar))
+
+    def decode(self, z):
+        height, width = z.shape[-2] * LATENT_FACTOR, z.shape[-1] * LATENT_FACTOR
+        chunk, tile = self.plan(height, width, DECODE_BYTES_PER_PIXEL)
+        if tile is None:
+            if chunk >= z.shape[0]:
+                return self.vae.decode(z)
+            sample = torch.cat([self.vae.decode(part).sample for part in z.split(chunk)], dim=0)
+        else:
+            sample = self._tiled(z, lambda part: self.vae.decode(part).sample, tile // LATENT_FACTOR,
+                                 self._overlap(tile) // LATENT_FACTOR, chunk, LATENT_FACTOR)
+        return SimpleNamespace(sample=sample)
+
+    def _overlap(self, tile):
+        # in pixels, a whole number of latent pixels
+        return min(self.tile_overlap, tile // 2) // LATENT_FACTOR * LATENT_FACTOR
+
+    def _moments(self, x):
+        latent_dist = self.vae.encode(x).latent_dist
+        return torch.cat([latent_dist.mean, latent_dist.logvar], dim=1)
+
+    def _tiled(self, x, fn, tile, overlap, chunk, scale):
+        """
+        fn on overlapping tile x tile crops of x (tile and overlap in x's
+        pixels), `scale` is fn's spatial output / input ratio. Crops of all
+        images share chunks.
+        """
+        batch, _, height, width = x.shape
+        ys, xs = tile_positions(height, tile, overlap), tile_positions(width, tile, overlap)
+        crops = [(b, y, x0) for b in range(batch) for y in ys for x0 in xs]
+        out_tile, out_overlap = int(tile * scale), int(overlap * scale)
+        window = blend_window(out_tile, out_overlap, x.device)
+
+        weight = torch.zeros(1, 1, int(height * scale), int(width * scale), device=x.device)
+        for y in ys:
+            for x0 in xs:
+                weight[..., int(y * scale):int(y * scale) + out_tile, int(x0 * scale):int(x0 * scale) + out_tile] += window
+        out = None
+        for start in range(0, len(crops), chunk):
+            group = crops[start:start + chunk]
+            result = fn(torch.cat([x[b:b + 1, :, y:y + tile, x0:x0 + tile] for b, y, x0 in group], dim=0)).float()
+            if out is None:
+                out = torch.zeros(batch, result.shape[1], weight.shape[-2], weight.shape[-1], device=x.device)
+            for (b, y, x0), part in zip(group, result.split(1)):
+                oy, ox = int(y * scale), int(x0 * scale)
+                out[b:b + 1, :, oy:oy + out_tile, ox:ox + out_tile] += window * part
+        return out / weight
+
+
+def bounded_vae(vae, config):
+    """
+    Wraps vae in ChunkedVAE when config.model.vae_memory_mb is set; 0 keeps the
+    single whole-batch call
+    """
+    budget_mb = getattr(config.model, 'vae_memory_mb', 0)
+    if not budget_mb:
+        return vae
+    return ChunkedVAE(vae, budget_mb, getattr(config.model, 'vae_tile_overlap', 64))
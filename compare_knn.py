@@ -0,0 +1,83 @@
+import argparse
+import copy
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from dataset import MVTecDataset
+from feature_extractor import load_feature_extractor
+from test import build_knn, get_bin_ids, knn_features, steps_from_bins
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD compressed KNN report')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--compression', nargs='+', default=['random', 'pca'],
+                                help='compressions compared with the exact KNN')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def split_features(feature_extractor, config, is_train):
+    dataset = MVTecDataset(root=config.data.data_dir, category=config.data.category, config=config, is_train=is_train)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=config.data.DA_batch_size if is_train else config.data.batch_size,
+                                         shuffle=False, num_workers=config.model.num_workers, drop_last=False)
+    with torch.no_grad():
+        return torch.cat([knn_features(feature_extractor, batch[0], config) for batch in loader], dim=0)
+
+
+def fit_and_query(config, train, test):
+    knn = build_knn(config)
+    knn.fit(train)
+    start = time.time()
+    distances, indices = knn.transform(test)
+    step_size, _ = steps_from_bins(get_bin_ids(knn, distances).cpu().numpy(), config)
+    if str(config.model.device).startswith('cuda'):
+        torch.cuda.synchronize()
+    return {
+        'step_size': step_size,
+        'indices': indices.cpu().numpy(),
+        'bank_mb': knn.nbytes() / 2 ** 20,
+        'pickle_mb': len(pickle.dumps(knn)) / 2 ** 20,
+        'query_ms': (time.time() - start) / len(test) * 1000,
+    }
+
+
+def main():
+    """
+    Step sizes validate would choose for the test split with the exact KNN and
+    with each compressed memory bank, fitted on the same train descriptors.
+    """
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+    # the extractor validate scored with: ImageNet weights unless domain adaptation saved a checkpoint
+    feature_extractor = load_feature_extractor(config)
+    train = split_features(feature_extractor, config, is_train=True)
+    test = split_features(feature_extractor, config, is_train=False)
+    print(f"{train.shape[0]} train / {test.shape[0]} test descriptors of {train.shape[1]} floats")
+
+    config.model.knn_compression = 'none'
+    rows = {'exact': fit_and_query(config, train, test)}
+    for compression in args.compression:
+        compressed_config = copy.deepcopy(config)
+        compressed_config.model.knn_compression = compression
+        rows[compression] = fit_and_query(compressed_config, train, test)
+
+    exact = rows['exact']
+    print("\n=== compressed KNN vs exact ===")
+    print(f"{'bank':<8}{'bank MB':>10}{'pickle MB':>11}{'query ms':>10}{'steps changed':>15}{'mean |d step|':>15}{'max |d step|':>14}{'recall@k':>10}")
+    for name, row in rows.items():
+        delta = np.abs(row['step_size'] - exact['step_size'])
+        recall = np.mean([len(np.intersect1d(a, b)) / len(b) for a, b in zip(row['indices'], exact['indices'])])
+        print(f"{name:<8}{row['bank_mb']:>10.2f}{row['pickle_mb']:>11.2f}{row['query_ms']:>10.2f}"
+              f"{np.mean(delta > 0):>15.1%}{delta.mean():>15.2f}{delta.max():>14.0f}{recall:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -170,6 +170,17 @@ class MVTecDataset(torch.utils.data.Dataset):
 
 
 
+class IndexedDataset(torch.utils.data.Dataset):
+    """Wraps a dataset so every item also returns its dataset index as the last element"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return (*self.dataset[index], index)
+
 def load_data(dataset_name='cifar10',normal_class=0,batch_size= 32):
 
 
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import pickle
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from feature_extractor import load_feature_extractor
+from main import constant, load_model
+from registry import get_vae
+
+
+class VAEEncoder(nn.Module):
+    """AutoencoderKL encoder returning the latent distribution as (mean, logvar)"""
+    def __init__(self, vae):
+        super().__init__()
+        self.encoder = vae.encoder
+        self.quant_conv = vae.quant_conv
+
+    def forward(self, x):
+        mean, logvar = self.quant_conv(self.encoder(x)).chunk(2, dim=1)
+        return mean, torch.clamp(logvar, -30.0, 20.0)
+
+
+class VAEDecoder(nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.post_quant_conv = vae.post_quant_conv
+        self.decoder = vae.decoder
+
+    def forward(self, z):
+        return self.decoder(self.post_quant_conv(z))
+
+
+class FeatureStages(nn.Module):
+    """ResNet feature extractor returning its stages as a tuple (TorchScript friendly)"""
+    def __init__(self, fe):
+        super().__init__()
+        self.fe = fe
+
+    def forward(self, x):
+        return tuple(self.fe(x))
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD export')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--out', default='exported', help='artifact directory')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def export(config, out_dir):
+    """
+    Trace the UNet for the evaluation latent shape, the VAE encoder / decoder and
+    the feature extractor with TorchScript into `out_dir`, together with the
+    config, the beta schedule and the fitted KNN. Load it with artifact.load_artifact.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    device = torch.device(config.model.device)
+    batch_size = config.data.batch_size
+    image = torch.randn(batch_size, 3, config.data.image_size, config.data.image_size, device=device)
+    latent = torch.randn(batch_size, config.data.imput_channel, config.model.latent_size, config.model.latent_size, device=device)
+    t = torch.full((batch_size,), float(config.model.test_trajectoy_steps), device=device)
+
+    # traced modules run in float32 and NCHW; the int8 / pruned / distilled variants trace the same way
+    config.model.inference_dtype = 'float32'
+    config.model.channels_last = False
+    unet = load_model(config)
+    unet = getattr(unet, 'module', unet)
+    vae = get_vae(config)
+    modules = {
+        'unet': (unet, (latent, t)),
+        'vae_encoder': (VAEEncoder(vae).eval(), (image,)),
+        'vae_decoder': (VAEDecoder(vae).eval(), (latent,)),
+        'feature_extractor': (FeatureStages(load_feature_extractor(config)).eval(), (image,)),
+    }
+    with torch.no_grad():
+        for name, (module, inputs) in modules.items():
+            traced = torch.jit.trace(module, inputs, check_trace=False)
+            traced.save(os.path.join(out_dir, f'{name}.pt'))
+            print(f"exported {name}")
+
+    torch.save(constant(config)['betas'].cpu(), os.path.join(out_dir, 'betas.pt'))
+    knn = os.path.join(os.getcwd(), config.model.checkpoint_dir, config.data.category, f"knn_{config.model.knn_k}_{config.model.DA_epochs}")
+    if os.path.exists(knn):
+        # plain dict so unpickling does not need test.KNN (and with it diffusers); a
+        # compressed bank keeps its product_quantization objects, which need torch only
+        with open(knn, 'rb') as f:
+            knn = pickle.load(f)
+        with open(os.path.join(out_dir, 'knn.pkl'), 'wb') as f:
+            pickle.dump({name: value for name, value in knn.__getstate__().items() if name != 'config'}, f)
+    OmegaConf.save(config, os.path.join(out_dir, 'config.yaml'))
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump({
+            'modules': list(modules),
+            'latent_scale': 0.18215,
+            'image_size': config.data.image_size,
+            'latent_shape': list(latent.shape[1:]),
+            'traced_batch_size': batch_size,
+            'torch': torch.__version__,
+        }, f, indent=2)
+    return out_dir
+
+
+def main():
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+    export(config, args.out)
+    print(f"artifact written to {os.path.abspath(args.out)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,18 @@ from diffusers import AutoencoderKL
 
 torch.manual_seed(42)
 
+FE_BACKBONES = {
+    'wide_resnet50': wide_resnet50_2,
+    'resnet34': resnet34,
+    'resnet101': resnet101,
+    'wide_resnet101': wide_resnet101_2,
+}
+
+def build_feature_extractor(config, pretrained=True):
+    if config.model.fe_backbone not in FE_BACKBONES:
+        raise ValueError(f"no valid fe backbone selected: {config.model.fe_backbone}")
+    return FE_BACKBONES[config.model.fe_backbone](pretrained=pretrained)[0]
+
 def build_model(config):
     unet = UNetModel(256, 64, dropout=0, n_heads=4 ,in_channels=config.data.fe_input_channel)
     return unet
@@ -32,7 +44,7 @@ def loss_fucntion(a, b, config):
     loss = 0
     
     for item in range(len(a)):
-        loss += torch.mean(1-cos_loss(a[item].view(a[item].shape[0],-1),b[item].view(b[item].shape[0],-1)))
+        loss += torch.mean(1-cos_loss(a[item].reshape(a[item].shape[0],-1),b[item].reshape(b[item].shape[0],-1)))
     return loss
 
 
@@ -74,11 +86,12 @@ def Domain_adaptation(unet, feature_extractor, vae, config, fine_tune, constants
                         test_trajectoy_steps = torch.Tensor([config.model.test_trajectoy_steps_DA]).type(torch.int64).to(config.model.device)
                         seq = range(0 , config.model.test_trajectoy_steps_DA, config.model.skip_DA)
                         
-                    at = compute_alpha(constants_dict["betas"], test_trajectoy_steps.long(),config)
+                    at = get_schedule(constants_dict, config).alpha_bar(test_trajectoy_steps)
                     
                     
-                    target = batch[0].to(config.model.device)  
-                    target_vae = vae.encode(target.to(config.model.device)).latent_dist.sample() * 0.18215   
+                    target = to_channels_last(batch[0].to(config.model.device), config)
+                    with inference_autocast(config):
+                        target_vae = vae.encode(target.to(config.model.device)).latent_dist.sample().float() * 0.18215   
                     if config.model.noise_sampling:
                         noise = torch.randn_like(target_vae).to(config.model.device)
                         
@@ -90,8 +103,7 @@ def Domain_adaptation(unet, feature_extractor, vae, config, fine_tune, constants
                         
                     
                         
-                    reconstructed, _ = DA_generalized_steps(target_vae, noisy_image, seq, unet, constants_dict["betas"], config, eta2=config.model.eta2 , eta3=0 , constants_dict=constants_dict ,eraly_stop = False)
-                    data_reconstructed = reconstructed[-1].to(config.model.device)
+                    data_reconstructed, _ = DA_generalized_steps(target_vae, noisy_image, seq, unet, constants_dict["betas"], config, eta2=config.model.eta2 , eta3=0 , constants_dict=constants_dict ,eraly_stop = False, final_only=True)
                     del target_vae
                     del noisy_image
                     torch.cuda.empty_cache()
@@ -99,7 +111,8 @@ def Domain_adaptation(unet, feature_extractor, vae, config, fine_tune, constants
                     if config.model.consistency_decoder:
                         data_reconstructed = consistency_decoder(data_reconstructed)
                     else:
-                        data_reconstructed = vae.decode(data_reconstructed.to(config.model.device)).sample
+                        with inference_autocast(config):
+                            data_reconstructed = vae.decode(data_reconstructed.to(config.model.device)).sample.float()
                 
                 data_reconstructed = transform(data_reconstructed)
                 reconst_fe = feature_extractor(data_reconstructed)
@@ -124,3 +137,31 @@ def Domain_adaptation(unet, feature_extractor, vae, config, fine_tune, constants
         print("loaded fe recon sim")
     return feature_extractor
 
+
+def adapted_feature_extractor(unet, vae, config, constants_dict, dataloader, consistency_decoder=False):
+    """
+    The feature extractor validate scores with: ImageNet weights as the starting point,
+    then Domain_adaptation as config.model.DA_fine_tune selects (fine-tuned on dataloader
+    or loaded from the saved checkpoint)
+    """
+    feature_extractor = build_feature_extractor(config, pretrained=True)
+    feature_extractor.to(config.model.device)
+    feature_extractor = to_channels_last(feature_extractor, config)
+    feature_extractor = Domain_adaptation(unet, feature_extractor, vae, config, fine_tune=config.model.DA_fine_tune, constants_dict=constants_dict, dataloader=dataloader, consistency_decoder=consistency_decoder)
+    feature_extractor.eval()
+    return feature_extractor
+
+
+def load_feature_extractor(config):
+    """
+    The feature extractor validate scored with, without running domain adaptation again:
+    the checkpoint Domain_adaptation saved (fine-tuning) or loaded, and the ImageNet weights
+    when fine-tuning ran for 0 epochs and produced none
+    """
+    if config.model.DA_fine_tune and config.model.DA_epochs == 0:
+        feature_extractor = build_feature_extractor(config, pretrained=True)
+    else:
+        feature_extractor = build_feature_extractor(config, pretrained=False)
+        checkpoint = os.path.join(os.getcwd(), config.model.checkpoint_dir, config.data.category, f'feature_recon_sim{config.model.DA_epochs}')
+        feature_extractor.load_state_dict(torch.load(checkpoint, map_location=config.model.device))
+    return feature_extractor.to(config.model.device).eval()
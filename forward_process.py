@@ -3,23 +3,21 @@ import numpy as np
 from torch import nn
 import torch.nn.functional as F
 from typing import Dict, Tuple, Optional
+from utilities import DiffusionSchedule, get_schedule
+from noise import NoiseProvider
 
 class AdaptiveForwardDiffusion:
-    def __init__(self, config):
+    def __init__(self, config, schedule: Optional[DiffusionSchedule] = None):
         self.config = config
         self.device = config.model.device
+        self.schedule = schedule
         self.noise_generator = AdaptiveNoiseGenerator(config)
-        
-    def get_index_from_list(self, vals: torch.Tensor, t: torch.Tensor, x_shape: tuple, config) -> torch.Tensor:
-        """從列表中獲取時間步索引的輔助函數"""
-        batch_size = t.shape[0]
-        out = vals.gather(-1, t.cpu())
-        return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(config.model.device)
 
     def compute_alpha(self, beta: torch.Tensor, t: int, config) -> torch.Tensor:
-        """計算累積 α 值"""
-        beta = beta.to(self.device)
-        return torch.prod(1. - beta[:t + 1])
+        """計算累積 α 值 (直接索引預先計算的 schedule)"""
+        if self.schedule is None:
+            self.schedule = DiffusionSchedule(beta, self.device)
+        return self.schedule.alphas_cumprod_padded[t + 1]
 
     def forward_diffusion_sample(self, 
                                x_0: torch.Tensor, 
@@ -41,18 +39,18 @@ class AdaptiveForwardDiffusion:
             x: 噪聲化後的圖像
             noise: 添加的噪聲
         """
-        sqrt_alphas_cumprod = constant_dict['sqrt_alphas_cumprod']
-        sqrt_one_minus_alphas_cumprod = constant_dict['sqrt_one_minus_alphas_cumprod']
+        if self.schedule is None:
+            self.schedule = get_schedule(constant_dict, config)
         
         # 使用自適應噪聲生成器
         noise = self.noise_generator.get_noise(x_0, noise_type=noise_type)
         
         # 獲取對應時間步的值
-        sqrt_alphas_cumprod_t = self.get_index_from_list(
-            sqrt_alphas_cumprod, t, x_0.shape, config
+        sqrt_alphas_cumprod_t = self.schedule.extract(
+            'sqrt_alphas_cumprod', t, x_0.shape
         )
-        sqrt_one_minus_alphas_cumprod_t = self.get_index_from_list(
-            sqrt_one_minus_alphas_cumprod, t, x_0.shape, config
+        sqrt_one_minus_alphas_cumprod_t = self.schedule.extract(
+            'sqrt_one_minus_alphas_cumprod', t, x_0.shape
         )
         
         # 計算噪聲圖像
@@ -128,17 +126,20 @@ class AdaptiveNoiseGenerator:
             return adaptive_std
         return torch.tensor(1.0).to(self.device)
 
-    def get_noise(self, x: torch.Tensor, noise_type: str = 'adaptive_gaussian', seed: Optional[int] = None) -> torch.Tensor:
-        """生成自適應噪聲"""
+    def get_noise(self, x: torch.Tensor, noise_type: str = 'adaptive_gaussian', seed: Optional[int] = None,
+                  sample_ids: Optional[list] = None, t: int = 0) -> torch.Tensor:
+        """生成自適應噪聲 (給定 sample_ids 時使用逐樣本的 counter-based 噪聲流)"""
         if seed is not None:
             torch.manual_seed(seed)
             np.random.seed(seed)
 
-        if noise_type == 'adaptive_gaussian':
-            std = self.calculate_adaptive_std(x)
-            noise = torch.randn_like(x).to(self.device) * std
+        provider = NoiseProvider.from_config(self.config) if sample_ids is not None else None
+        if provider is not None:
+            noise = provider.randn_like(x, sample_ids, t).to(self.device)
         else:
             noise = torch.randn_like(x).to(self.device)
+        if noise_type == 'adaptive_gaussian':
+            noise = noise * self.calculate_adaptive_std(x)
 
         # 更新噪聲歷史
         if len(self.noise_history) >= 100:
@@ -150,10 +151,10 @@ class AdaptiveNoiseGenerator:
 # 主函數介面
 def forward_diffusion_sample(x_0, t, constant_dict, config, noise_type='adaptive_gaussian'):
     """主要的前向擴散採樣函數"""
-    diffusion = AdaptiveForwardDiffusion(config)
+    diffusion = AdaptiveForwardDiffusion(config, get_schedule(constant_dict, config))
     return diffusion.forward_diffusion_sample(x_0, t, constant_dict, config, noise_type)
 
-def forward_ti_steps(t, ti, x_t_ti, x_0, beta, config, noise_type='adaptive_gaussian'):
+def forward_ti_steps(t, ti, x_t_ti, x_0, beta, config, noise_type='adaptive_gaussian', schedule=None):
     """主要的前向時間插值步驟函數"""
-    diffusion = AdaptiveForwardDiffusion(config)
+    diffusion = AdaptiveForwardDiffusion(config, schedule)
     return diffusion.forward_ti_steps(t, ti, x_t_ti, x_0, beta, config, noise_type)
\ No newline at end of file
@@ -0,0 +1,127 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from dataset import MVTecDataset
+from registry import TRAIN_VAE, get_vae, registry, vae_key
+
+
+class CachedLatentDistribution:
+    """
+    Diagonal Gaussian rebuilt from a cached (mean, logvar) pair; the same
+    interface trainer uses on AutoencoderKL's latent_dist
+    """
+    def __init__(self, mean, logvar):
+        self.mean = mean
+        self.logvar = torch.clamp(logvar, -30.0, 20.0)
+        self.std = torch.exp(0.5 * self.logvar)
+
+    def sample(self):
+        return self.mean + self.std * torch.randn_like(self.mean)
+
+
+class LatentCache:
+    """
+    VAE latent distributions of the train split in one memory-mapped float16
+    array of shape [N, 2, C, h, w] holding (mean, logvar). index.json maps
+    each image path to its row and the file mtime it was encoded from.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.array_path = os.path.join(cache_dir, 'latents.npy')
+        self.index = {'meta': None, 'entries': {}}
+        if os.path.exists(self.index_path) and os.path.exists(self.array_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.load(self.array_path, mmap_mode='r')
+        return self._array
+
+    def rows(self, image_files, meta):
+        """Cached row of every image file, None where missing or stale"""
+        if self.index['meta'] != meta:
+            return [None] * len(image_files)
+        rows = []
+        for path in image_files:
+            entry = self.index['entries'].get(os.path.abspath(path))
+            valid = entry is not None and entry['mtime'] == os.path.getmtime(path)
+            rows.append(entry['row'] if valid else None)
+        return rows
+
+    def write(self, image_files, latents, meta):
+        """Replace the cache with `latents` ([N, 2, C, h, w]) aligned with image_files"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.array_path + '.tmp.npy'
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=latents.shape)
+        array[:] = latents
+        array.flush()
+        del array
+        self._array = None
+        os.replace(tmp_path, self.array_path)
+        self.index = {
+            'meta': meta,
+            'entries': {os.path.abspath(path): {'row': row, 'mtime': os.path.getmtime(path)} for row, path in enumerate(image_files)},
+        }
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f)
+
+
+class LatentDataset(torch.utils.data.Dataset):
+    """(mean, logvar, label) per train image, read from the memory-mapped cache"""
+    def __init__(self, cache, rows):
+        self.cache = cache
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        mean, logvar = torch.from_numpy(np.array(self.cache.array[self.rows[index]], dtype=np.float32))
+        return mean, logvar, 'good'
+
+
+def latent_cache_dir(config):
+    return os.path.join(os.getcwd(), config.model.latent_cache_dir, config.data.category)
+
+
+def build_latent_cache(config, train_dataset):
+    """
+    One-time preprocessing: encode the train images whose path / mtime is not
+    cached yet and return a LatentDataset over the whole split. The VAE is only
+    loaded when something has to be encoded and is offloaded again afterwards.
+    """
+    cache = LatentCache(latent_cache_dir(config))
+    image_files = train_dataset.image_files
+    meta = {'vae': '/'.join(TRAIN_VAE), 'image_size': config.data.image_size}
+    rows = cache.rows(image_files, meta)
+    missing = [i for i, row in enumerate(rows) if row is None]
+
+    if missing:
+        print(f"encoding {len(missing)} of {len(image_files)} train images into the latent cache")
+        vae = get_vae(config, TRAIN_VAE)
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_dataset, missing), batch_size=config.data.batch_size,
+                                             shuffle=False, num_workers=config.model.num_workers)
+        encoded = []
+        with torch.no_grad():
+            for batch in loader:
+                latent_dist = vae.encode(batch[0].to(config.model.device)).latent_dist
+                encoded.append(torch.stack([latent_dist.mean, latent_dist.logvar], dim=1).cpu())
+        encoded = torch.cat(encoded, dim=0).half().numpy()
+        # training reads the cache only, the VAE leaves device memory
+        registry.offload(vae_key(TRAIN_VAE))
+
+        latents = np.empty((len(image_files),) + encoded.shape[1:], dtype=np.float16)
+        for i, row in enumerate(rows):
+            if row is not None:
+                latents[i] = cache.array[row]
+        latents[missing] = encoded
+        cache.write(image_files, latents, meta)
+
+    return LatentDataset(cache, list(range(len(image_files))))
@@ -4,8 +4,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 from forward_process import *
 from noise import *
+from utilities import get_schedule
 
-def get_loss(model, constant_dict, x_0, t, config):
+def get_loss(model, constant_dict, x_0, t, config, noise_provider=None, sample_ids=None):
     """
     自適應損失函數計算，融合多重策略優化模型性能
     
@@ -15,19 +16,23 @@ def get_loss(model, constant_dict, x_0, t, config):
     - x_0: 原始輸入數據
     - t: 時間步驟
     - config: 模型配置
+    - noise_provider / sample_ids: 給定時噪聲由 (seed, sample id, t) 決定, 與 batch 組成無關
     
     返回:
     - 自適應計算的損失值
     """
     # 將張量移動到指定設備
     x_0 = x_0.to(config.model.device)
-    b = constant_dict['betas'].to(config.model.device)
+    schedule = get_schedule(constant_dict, config)
     
     # 生成隨機噪聲
-    e = torch.randn_like(x_0, device=x_0.device)
+    if noise_provider is not None:
+        e = noise_provider.randn_like(x_0, sample_ids, t.tolist())
+    else:
+        e = torch.randn_like(x_0, device=x_0.device)
     
     # 計算alpha_t並添加噪聲到輸入
-    at = (1-b).cumprod(dim=0).index_select(0, t).view(-1, 1, 1, 1)
+    at = schedule.alpha_bar(t)
     x = at.sqrt() * x_0 + (1 - at).sqrt() * e
     
     # 模型前向傳播
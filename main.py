@@ -2,6 +2,7 @@ import torch
 import numpy as np
 import os
 import argparse
+import copy
 import time
 
 from unet import *
@@ -9,10 +10,14 @@ from test import validate
 from omegaconf import OmegaConf
 from utilities import *
 import torch.nn.functional as F
-from train import trainer
+from train import trainer, distill_trainer, distilled_checkpoint_path
 from datetime import timedelta
 from feature_extractor import *
 from collections import OrderedDict
+from quantization import load_int8_unet
+from tiled import tiled_validate
+from registry import registry
+from pruning import apply_widths, load_widths, pruned_checkpoint_path
 
 #os.environ['CUDA_VISIBLE_DEVICES'] = "0,1,2"
 def constant(config):
@@ -20,23 +25,18 @@ def constant(config):
 
     betas = beta_schedule(beta_schedule = config.model.schedule, beta_start = config.model.beta_start, beta_end=config.model.beta_end, num_diffusion_timesteps=config.model.trajectory_steps)
 
-    # Pre-calculate different terms for closed form
-    alphas = 1. - betas
-    alphas_cumprod = torch.cumprod(alphas, axis=0)
-    alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.0)
-    sqrt_recip_alphas = torch.sqrt(1.0 / alphas)
-    sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-    sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - alphas_cumprod)
-    posterior_variance = betas * (1. - alphas_cumprod_prev) / (1. - alphas_cumprod)
+    # Pre-calculate different terms for closed form, once, on the compute device
+    schedule = DiffusionSchedule(betas, config.model.device)
     constants_dict = {
-        'betas' : betas,
-        'alphas': alphas,
-        'alphas_cumprod' : alphas_cumprod,
-        'alphas_cumprod_prev' : alphas_cumprod_prev,
-        'sqrt_recip_alphas' : sqrt_recip_alphas,
-        'sqrt_alphas_cumprod' : sqrt_alphas_cumprod,
-        'sqrt_one_minus_alphas_cumprod' : sqrt_one_minus_alphas_cumprod,
-        'posterior_variance' : posterior_variance,
+        'betas' : schedule.betas,
+        'alphas': schedule.alphas,
+        'alphas_cumprod' : schedule.alphas_cumprod,
+        'alphas_cumprod_prev' : schedule.alphas_cumprod_prev,
+        'sqrt_recip_alphas' : schedule.sqrt_recip_alphas,
+        'sqrt_alphas_cumprod' : schedule.sqrt_alphas_cumprod,
+        'sqrt_one_minus_alphas_cumprod' : schedule.sqrt_one_minus_alphas_cumprod,
+        'posterior_variance' : schedule.posterior_variance,
+        'schedule' : schedule,
     }
     return constants_dict
 
@@ -57,6 +57,9 @@ def train(args):
     config = OmegaConf.load(args.config)
     
     unet = build_model(config)
+    if getattr(config.model, 'gradient_checkpointing', False):
+        # recompute ResBlock / AttentionBlock activations in backward to fit larger batches
+        unet.set_gradient_checkpointing(True)
     print("Num params: ", sum(p.numel() for p in unet.parameters()))
     print(f'Current device is {config.model.device}')
     unet = unet.to(config.model.device)
@@ -72,6 +75,8 @@ def train(args):
     constants_dict = constant(config)
     start = time.time()
     trainer(unet, constants_dict, ema_helper, config)
+    # load_model(config, trained=True) picks the trained UNet up from the registry
+    registry.put('unet:trained', unet)
     end = time.time()
     print('training time on ',config.model.epochs,' epochs is ', str(timedelta(seconds=end - start)),'\n')
     with open('readme.txt', 'a') as f:
@@ -81,11 +86,57 @@ def train(args):
         
 
 
-def evaluate(args):
-    start = time.time()
-    config = OmegaConf.load(args.config)
+def unet_variant(config):
+    if getattr(config.model, 'quantized', False):
+        return 'int8'
+    if getattr(config.model, 'pruned', False):
+        return 'pruned'
+    if getattr(config.model, 'distilled_rounds', 0):
+        return f'distilled{config.model.distilled_rounds}'
+    return 'base'
+
+
+def load_model(config, trained=False):
+    """
+    Returns the evaluation UNet selected by the config from the model registry,
+    loading it on first use. The checkpoint_epochs checkpoint is read from disk;
+    trained=True returns the UNet trained in this process instead.
+    """
+    dtype = getattr(config.model, 'inference_dtype', 'float32')
+    if trained:
+        return registry.get(f"unet:trained:{dtype}", lambda: _trained_model(config), config.model.device)
+    # configs that differ in checkpoint, device or placement get their own instance
+    key = (f"unet:{unet_variant(config)}:{config.model.checkpoint_dir}/{config.data.category}:{config.model.checkpoint_epochs}"
+           f":{config.model.device}:{dtype}:channels_last={use_channels_last(config)}")
+    return registry.get(key, lambda: _load_model(config), config.model.device)
+
+
+def _trained_model(config):
+    if 'unet:trained' not in registry:
+        raise KeyError("no UNet was trained in this process")
+    unet = registry.get('unet:trained')
+    if get_inference_dtype(config) != torch.float32:
+        # convert_to_dtype works in place, keep the trained float32 copy intact
+        unet = copy.deepcopy(unet)
+    return _place_model(unet, config)
+
+
+def _load_model(config):
+    """
+    Builds the UNet and loads the evaluation checkpoint selected by the config.
+    """
     unet = build_model(config)
-    if config.data.category:
+    if getattr(config.model, 'quantized', False):
+        # int8 weights written by quantize_unet.py, see quantization.py
+        return load_int8_unet(unet, config)
+    if getattr(config.model, 'pruned', False):
+        # slimmer UNet written by prune_unet.py, see pruning.py
+        apply_widths(unet, load_widths(config))
+        checkpoint = torch.load(pruned_checkpoint_path(config), map_location=config.model.device)
+    elif getattr(config.model, 'distilled_rounds', 0):
+        # few-step student written by distill_trainer, validate samples it on distilled_seq
+        checkpoint = torch.load(distilled_checkpoint_path(config, config.model.distilled_rounds), map_location=config.model.device)
+    elif config.data.category:
         checkpoint = torch.load(os.path.join(os.path.join(os.getcwd(), config.model.checkpoint_dir), config.data.category,f"{config.model.latent_size}_{config.model.unet_channel}_{config.model.n_head}_{config.model.head_channel}_diffusers_unet_"+str(config.model.checkpoint_epochs)), map_location=config.model.device )
     else:
         checkpoint = torch.load(os.path.join(os.path.join(os.getcwd(), config.model.checkpoint_dir), '1000'), map_location=config.model.device)
@@ -103,8 +154,25 @@ def evaluate(args):
             
         #unet.load_state_dict(new_state_dict)
      	unet.load_state_dict(checkpoint)
+    return _place_model(unet, config)
+
+
+def _place_model(unet, config):
     unet.to(config.model.device)
+    unet = to_channels_last(unet, config)
     unet.eval()
+    dtype = get_inference_dtype(config)
+    if dtype != torch.float32:
+        # reduced precision inference, see UNetModel.convert_to_dtype
+        getattr(unet, 'module', unet).convert_to_dtype(dtype)
+    return unet
+
+
+def evaluate(args):
+    start = time.time()
+    config = OmegaConf.load(args.config)
+    unet = load_model(config)
+    unet = compile_unet(unet, config)
 
 
     if False: #config.model.ema:
@@ -117,12 +185,31 @@ def evaluate(args):
     else:
         ema_helper = None
     constants_dict = constant(config)
-    validate(unet, constants_dict, config)
+    if getattr(config.data, 'tiled', False):
+        # large images: overlapping tiles stitched into full resolution maps
+        tiled_validate(unet, constants_dict, config)
+    else:
+        validate(unet, constants_dict, config)
     end = time.time()
     print('Test time is ', str(timedelta(seconds=end - start)))
 
 
 
+def distill(args):
+    config = OmegaConf.load(args.config)
+    # the teacher is the regular float checkpoint
+    config.model.distilled_rounds = 0
+    config.model.inference_dtype = 'float32'
+    teacher = load_model(config)
+    constants_dict = constant(config)
+    start = time.time()
+    distill_trainer(teacher, constants_dict, config)
+    end = time.time()
+    print('distillation time is ', str(timedelta(seconds=end - start)))
+    print(f'evaluate the student with model.distilled_rounds: {config.model.distill_rounds}')
+
+
+
 def parse_args():
     cmdline_parser = argparse.ArgumentParser('D3AD')    
     cmdline_parser.add_argument('-cfg', '--config', 
@@ -131,6 +218,9 @@ def parse_args():
     cmdline_parser.add_argument('--eval', 
                                 default= False, 
                                 help='only evaluate the model')
+    cmdline_parser.add_argument('--distill', 
+                                default= False, 
+                                help='distill the trained UNet into a few-step student')
     args, unknowns = cmdline_parser.parse_known_args()
     return args
 
@@ -150,6 +240,9 @@ def execute_main_test():
         config = OmegaConf.load(args.config)
         constants_dict = constant(config)
         evaluate(args)
+    elif args.distill:
+        print('distilling')
+        distill(args)
     else:
         train(args)
         evaluate(args)
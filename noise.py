@@ -3,6 +3,57 @@ import numpy as np
 from torch import nn
 import torch.nn.functional as F
 
+_MASK64 = (1 << 64) - 1
+
+def _splitmix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+class NoiseProvider:
+    """
+    Counter-based noise streams: the noise of every sample is derived from the key
+    (seed, sample id, timestep, stream) with its own generator (Philox on CUDA), so
+    it does not depend on batch composition, sharding or worker count.
+    `stream` separates independent draws that share a timestep (e.g. sampler noise
+    and VAE latent sampling).
+    """
+    def __init__(self, seed, device):
+        self.seed = int(seed)
+        self.device = torch.device(device)
+
+    @classmethod
+    def from_config(cls, config):
+        """None unless config.model.per_sample_noise is on"""
+        if not getattr(config.model, 'per_sample_noise', False):
+            return None
+        return cls(config.model.seed, config.model.device)
+
+    def key(self, sample_id, t, stream=0):
+        k = self.seed & _MASK64
+        for v in (sample_id, t, stream):
+            k = _splitmix64(k ^ (int(v) & _MASK64))
+        return k & ((1 << 63) - 1)
+
+    def randn_like(self, x, sample_ids, t, stream=0):
+        """
+        Standard normal noise shaped like x, one stream per sample id.
+        t is a single timestep or one timestep per sample.
+        """
+        if not isinstance(t, (list, tuple)):
+            t = [t] * len(sample_ids)
+        generator = torch.Generator(device=self.device)
+        samples = []
+        for sample_id, ti in zip(sample_ids, t):
+            generator.manual_seed(self.key(sample_id, ti, stream))
+            samples.append(torch.randn(x.shape[1:], generator=generator, device=self.device, dtype=x.dtype))
+        return torch.stack(samples).to(x.device)
+
+    def sample_latent(self, latent_dist, sample_ids, stream=1):
+        """Per-sample reparameterized draw from a diagonal Gaussian (e.g. VAE latent_dist)"""
+        return latent_dist.mean + latent_dist.std * self.randn_like(latent_dist.mean, sample_ids, 0, stream)
+
 class AdaptiveNoiseGenerator:
     def __init__(self, config):
         self.config = config
@@ -26,17 +77,20 @@ class AdaptiveNoiseGenerator:
             return adaptive_std
         return 1.0
 
-    def get_noise(self, x, noise_type='adaptive_gaussian', seed=None):
+    def get_noise(self, x, noise_type='adaptive_gaussian', seed=None, sample_ids=None, t=0):
         if seed is not None:
             torch.manual_seed(seed)
             np.random.seed(seed)
+        # gaussian noise from per-sample streams when sample ids are given
+        provider = NoiseProvider.from_config(self.config) if sample_ids is not None else None
+        randn_like = (lambda y: provider.randn_like(y, sample_ids, t)) if provider is not None else torch.randn_like
 
         if noise_type == 'adaptive_gaussian':
             std = self.calculate_adaptive_std(x)
-            noise = torch.randn_like(x).to(self.device) * std
+            noise = randn_like(x).to(self.device) * std
             
         elif noise_type == 'gaussian':
-            noise = torch.randn_like(x).to(self.device)
+            noise = randn_like(x).to(self.device)
             
         elif noise_type == 'uniform':
             noise = torch.rand_like(x).to(self.device) * 2 - 1
@@ -101,6 +155,6 @@ class AdaptiveNoiseGenerator:
         noise = base_noise.expand(shape)
         return noise
 
-def get_noise(x, config, noise_type='adaptive_gaussian', seed=None):
+def get_noise(x, config, noise_type='adaptive_gaussian', seed=None, sample_ids=None, t=0):
     noise_generator = AdaptiveNoiseGenerator(config)
-    return noise_generator.get_noise(x, noise_type=noise_type, seed=seed)
\ No newline at end of file
+    return noise_generator.get_noise(x, noise_type=noise_type, seed=seed, sample_ids=sample_ids, t=t)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import math
+
+import torch
+
+KMEANS_ITERS = 20
+
+
+def _cpu_state(obj, skip=()):
+    # tensors are pickled on the CPU so the state loads without the fitting device
+    return {name: value.cpu() if isinstance(value, torch.Tensor) else value
+            for name, value in obj.__dict__.items() if name not in skip}
+
+
+class RandomProjection:
+    """
+    Dense Rademacher projection to dim_out dimensions. The matrix is drawn
+    from a seed on the CPU, so only the seed is stored; it is rebuilt on first
+    use on each device.
+    """
+    def __init__(self, dim_in, dim_out, seed=0):
+        self.dim_in = dim_in
+        self.dim_out = dim_out
+        self.seed = seed
+        self._matrix = None
+
+    def matrix(self, device):
+        if self._matrix is None or self._matrix.device != torch.device(device):
+            generator = torch.Generator().manual_seed(self.seed)
+            signs = torch.randint(0, 2, (self.dim_in, self.dim_out), generator=generator).float() * 2 - 1
+            self._matrix = (signs / math.sqrt(self.dim_out)).to(device)
+        return self._matrix
+
+    def __call__(self, X):
+        return X @ self.matrix(X.device)
+
+    def nbytes(self):
+        return 0
+
+    def to(self, device):
+        self.matrix(device)
+        return self
+
+    def __getstate__(self):
+        return dict(_cpu_state(self, skip=('_matrix',)), _matrix=None)
+
+
+class PCAProjection:
+    """Projection onto the top dim_out principal components of the fitted rows"""
+    def __init__(self, mean, components):
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def fit(cls, X, dim_out):
+        mean = X.mean(dim=0)
+        q = min(dim_out, *X.shape)
+        _, _, components = torch.pca_lowrank(X - mean, q=q, center=False)
+        if q < dim_out:
+            # fewer rows than dimensions: the missing components are zero
+            components = torch.cat([components, components.new_zeros(components.shape[0], dim_out - q)], dim=1)
+        return cls(mean, components)
+
+    def __call__(self, X):
+        return (X - self.mean.to(X.device)) @ self.components.to(X.device)
+
+    def nbytes(self):
+        return (self.mean.numel() + self.components.numel()) * self.components.element_size()
+
+    def to(self, device):
+        self.mean, self.components = self.mean.to(device), self.components.to(device)
+        return self
+
+    def __getstate__(self):
+        return _cpu_state(self)
+
+
+class ProductQuantizer:
+    """
+    Splits vectors into num_subspaces sub-vectors and stores each as the index
+    of its nearest k-means centroid (2**bits per subspace, one byte for 8 bits).
+    Distances are asymmetric: exact query sub-vectors against the centroids
+    (distance_tables), summed over the codes of the stored rows (adc).
+    """
+    def __init__(self, num_subspaces, bits=8, seed=0):
+        if bits > 8:
+            raise ValueError(f"product quantization codes are one byte, bits must be <= 8, got {bits}")
+        self.num_subspaces = num_subspaces
+        self.bits = bits
+        self.seed = seed
+        self.centroids = None
+
+    def _split(self, X):
+        if X.shape[1] % self.num_subspaces:
+            raise ValueError(f"dimension {X.shape[1]} is not divisible into {self.num_subspaces} subspaces")
+        # [num_subspaces, N, sub_dim]
+        return X.reshape(X.shape[0], self.num_subspaces, -1).transpose(0, 1)
+
+    def fit(self, X):
+        """k-means in every subspace at once, initialised from random rows"""
+        sub = self._split(X).contiguous()
+        num_centroids = min(2 ** self.bits, X.shape[0])
+        generator = torch.Generator().manual_seed(self.seed)
+        init = torch.randperm(X.shape[0], generator=generator)[:num_centroids].to(X.device)
+        centroids = sub[:, init].clone()
+        for _ in range(KMEANS_ITERS):
+            assign = torch.cdist(sub, centroids).argmin(dim=2)
+            sums = torch.zeros_like(centroids).scatter_add_(1, assign[..., None].expand_as(sub), sub)
+            counts = torch.zeros(centroids.shape[:2], device=X.device).scatter_add_(1, assign, torch.ones_like(assign, dtype=torch.float))
+            # empty clusters keep their centroid
+            centroids = torch.where(counts[..., None] > 0, sums / counts.clamp(min=1)[..., None], centroids)
+        self.centroids = centroids
+        return self
+
+    def encode(self, X):
+        """[N, num_subspaces] uint8 codes"""
+        return torch.cdist(self._split(X).contiguous(), self.centroids.to(X.device)).argmin(dim=2).T.to(torch.uint8)
+
+    def distance_tables(self, Q):
+        """[B, num_subspaces, centroids] squared distances of query sub-vectors to every centroid"""
+        return (torch.cdist(self._split(Q).contiguous(), self.centroids.to(Q.device)) ** 2).transpose(0, 1)
+
+    @staticmethod
+    def adc(tables, codes):
+        """[B, n] squared distances of the queries behind `tables` to the rows behind `codes`"""
+        codes = codes.long()
+        distances = tables.new_zeros(tables.shape[0], codes.shape[0])
+        for m in range(codes.shape[1]):
+            distances += tables[:, m, codes[:, m]]
+        return distances
+
+    def nbytes(self):
+        return self.centroids.numel() * self.centroids.element_size()
+
+    def to(self, device):
+        self.centroids = self.centroids.to(device)
+        return self
+
+    def __getstate__(self):
+        return _cpu_state(self)
@@ -0,0 +1,125 @@
+import argparse
+import copy
+import os
+import time
+
+import torch
+from omegaconf import OmegaConf
+from torchmetrics import AUROC
+
+from dataset import MVTecDataset
+from loss import get_loss
+from main import constant, load_model
+from optimizer import build_optimizer
+from pruning import channel_importance, prune_unet, pruned_checkpoint_path, save_widths
+from registry import TRAIN_VAE, get_vae, release, vae_key
+from test import validate
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD structured channel pruning')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--ratio', type=float, default=0.5,
+                                help='fraction of ResBlock hidden channels and attention heads to keep')
+    cmdline_parser.add_argument('--importance_batches', type=int, default=16,
+                                help='train batches used to rank channels')
+    cmdline_parser.add_argument('--finetune_epochs', type=int, default=2,
+                                help='epochs of get_loss fine-tuning after pruning')
+    cmdline_parser.add_argument('--skip_eval', action='store_true',
+                                help='only write the pruned model, no AUROC comparison')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def train_latents(config, vae, loader, num_batches=None):
+    """VAE latents of the train split, encoded on the fly as in trainer"""
+    with torch.no_grad():
+        for step, batch in enumerate(loader):
+            if step == num_batches:
+                break
+            yield vae.encode(batch[0].to(config.model.device)).latent_dist.sample() * 0.18215
+
+
+def finetune(unet, vae, loader, constants_dict, config, epochs):
+    optimizer = build_optimizer(unet, config)
+    unet.train()
+    for epoch in range(epochs):
+        for step, x_0 in enumerate(train_latents(config, vae, loader)):
+            t = torch.randint(0, config.model.trajectory_steps, (x_0.shape[0],), device=config.model.device).long()
+            optimizer.zero_grad()
+            loss = get_loss(unet, constants_dict, x_0, t, config)
+            loss.backward()
+            optimizer.step()
+        print(f"Fine-tune epoch {epoch} | Loss: {loss.item():.4f}")
+    unet.eval()
+    return unet
+
+
+def latency_ms(unet, config, iters=10):
+    device = torch.device(config.model.device)
+    x = torch.randn(config.data.batch_size, config.data.imput_channel, config.model.latent_size, config.model.latent_size, device=device)
+    t = torch.full((config.data.batch_size,), config.model.test_trajectoy_steps // 2, device=device)
+    with torch.no_grad():
+        unet(x, t)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(iters):
+            unet(x, t)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / iters * 1000
+
+
+def report_row(unet, config, evaluate):
+    row = {'params': sum(p.numel() for p in unet.parameters()), 'latency': latency_ms(unet, config), 'auroc': float('nan')}
+    if evaluate:
+        torch.manual_seed(42)
+        results = validate(unet, constant(config), config)
+        row['auroc'] = AUROC(task="binary")(torch.tensor(results['predictions']), torch.tensor(results['labels'])).item()
+    return row
+
+
+def main():
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+    config.model.pruned = False
+    config.model.quantized = False
+
+    dense = load_model(config)
+    constants_dict = constant(config)
+    dataset = MVTecDataset(root=config.data.data_dir, category=config.data.category, config=config, is_train=True)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=config.data.batch_size, shuffle=True,
+                                         num_workers=config.model.num_workers, drop_last=True)
+    vae = get_vae(config, TRAIN_VAE)
+
+    slim = copy.deepcopy(dense).float()
+    slim.dtype = torch.float32
+    scores = channel_importance(slim, train_latents(config, vae, loader, args.importance_batches), constants_dict, config)
+    widths = prune_unet(slim, scores, args.ratio)
+    finetune(slim, vae, loader, constants_dict, config, args.finetune_epochs)
+    release(vae_key(TRAIN_VAE), config)
+
+    torch.save(slim.state_dict(), pruned_checkpoint_path(config))
+    save_widths(widths, config)
+    print(f"pruned UNet written to {pruned_checkpoint_path(config)} (+ .json widths)")
+
+    before = report_row(dense, config, not args.skip_eval)
+    del dense, slim
+    torch.cuda.empty_cache()
+    # reload the way evaluate in main.py does with model.pruned set
+    config.model.pruned = True
+    after = report_row(load_model(config), config, not args.skip_eval)
+
+    print("\n=== structured pruning ===")
+    print(f"{'model':<8}{'params':>14}{'latency ms':>12}{'AUROC':>9}")
+    for name, row in (('dense', before), ('pruned', after)):
+        print(f"{name:<8}{row['params']:>14,}{row['latency']:>12.2f}{row['auroc']:>9.4f}")
+    print(f"params x{before['params'] / after['params']:.2f} smaller, latency x{before['latency'] / after['latency']:.2f} faster, "
+          f"AUROC {after['auroc'] - before['auroc']:+.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import json
+import os
+
+import torch
+
+from loss import get_loss
+from unet import AttentionBlock, ResBlock
+
+
+def pruned_checkpoint_path(config):
+    return os.path.join(os.getcwd(), config.model.checkpoint_dir, config.data.category,
+                        f"{config.model.latent_size}_{config.model.unet_channel}_{config.model.n_head}_{config.model.head_channel}_diffusers_unet_{config.model.checkpoint_epochs}_pruned")
+
+
+def prunable_blocks(unet):
+    return {name: module for name, module in unet.named_modules() if isinstance(module, (ResBlock, AttentionBlock))}
+
+
+def current_widths(unet):
+    """
+    Slim UNet config: hidden channels of every ResBlock and heads of every
+    AttentionBlock, keyed by module name
+    """
+    widths = {}
+    for name, block in prunable_blocks(unet).items():
+        if isinstance(block, ResBlock):
+            widths[name] = {'channels': block.hidden_channels}
+        else:
+            widths[name] = {'heads': block.num_heads}
+    return widths
+
+
+def apply_widths(unet, widths):
+    """Shrink a freshly built UNetModel to `widths` so a pruned state dict can be loaded"""
+    for name, width in widths.items():
+        block = unet.get_submodule(name)
+        if 'channels' in width:
+            block.prune_channels(torch.arange(width['channels']))
+        else:
+            block.prune_heads(torch.arange(width['heads']))
+    return unet
+
+
+def save_widths(widths, config):
+    with open(pruned_checkpoint_path(config) + '.json', 'w') as f:
+        json.dump(widths, f, indent=2)
+
+
+def load_widths(config):
+    with open(pruned_checkpoint_path(config) + '.json') as f:
+        return json.load(f)
+
+
+def _taylor(param):
+    # first order Taylor estimate of the loss change when the weight is removed
+    return (param.detach() * param.grad).abs()
+
+
+def _resblock_scores(block):
+    in_conv, linear = block.in_layers[-1], block.embed_layers[1]
+    norm, out_conv = block.out_layers[0], block.out_layers[-1]
+    return (_taylor(in_conv.weight).sum(dim=(1, 2, 3)) + _taylor(in_conv.bias)
+            + _taylor(linear.weight).sum(dim=1) + _taylor(linear.bias)
+            + _taylor(norm.weight) + _taylor(norm.bias)
+            + _taylor(out_conv.weight).sum(dim=(0, 2, 3)))
+
+
+def _attention_scores(block):
+    heads = block.num_heads
+    qkv = _taylor(block.to_qkv.weight).sum(dim=(1, 2)) + _taylor(block.to_qkv.bias)
+    out = _taylor(block.proj_out.weight).sum(dim=(0, 2))
+    return qkv.view(heads, -1).sum(dim=1) + out.view(heads, -1).sum(dim=1)
+
+
+def channel_importance(unet, latents, constants_dict, config):
+    """
+    Accumulated Taylor importance of every ResBlock hidden channel and every
+    attention head, from get_loss gradients on train latents
+    """
+    blocks = prunable_blocks(unet)
+    scores = {}
+    unet.train()
+    for x_0 in latents:
+        unet.zero_grad()
+        t = torch.randint(0, config.model.trajectory_steps, (x_0.shape[0],), device=config.model.device).long()
+        get_loss(unet, constants_dict, x_0, t, config).backward()
+        for name, block in blocks.items():
+            score = _resblock_scores(block) if isinstance(block, ResBlock) else _attention_scores(block)
+            scores[name] = scores.get(name, 0) + score
+    unet.zero_grad()
+    unet.eval()
+    return scores
+
+
+def _select(scores, ratio, multiple):
+    k = int(round(len(scores) * ratio / multiple)) * multiple
+    k = min(max(k, multiple), len(scores))
+    return torch.topk(scores, k).indices.sort().values
+
+
+def prune_unet(unet, scores, ratio):
+    """
+    Keep the `ratio` most important hidden channels of every ResBlock (in
+    multiples of 32 for GroupNorm32) and heads of every AttentionBlock.
+    Returns the slim widths config.
+    """
+    for name, block in prunable_blocks(unet).items():
+        if isinstance(block, ResBlock):
+            block.prune_channels(_select(scores[name], ratio, 32))
+        else:
+            block.prune_heads(_select(scores[name], ratio, 1))
+    unet.clear_time_cache()
+    return current_widths(unet)
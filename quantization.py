@@ -0,0 +1,92 @@
+import os
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import (QuantWrapper, convert, default_dynamic_qconfig, get_default_qconfig,
+                                   prepare, quantize_dynamic)
+from torch.ao.quantization.quantization_mappings import get_default_dynamic_quant_module_mappings
+
+from sample import distilled_seq, reverse_schedules, validate_steps
+from utilities import get_schedule
+
+
+def quantized_engine():
+    """x86 (oneDNN + fbgemm) when this torch build has it, fbgemm otherwise"""
+    engines = torch.backends.quantized.supported_engines
+    engine = 'x86' if 'x86' in engines else 'fbgemm'
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def int8_checkpoint_path(config):
+    return os.path.join(os.getcwd(), config.model.checkpoint_dir, config.data.category,
+                        f"{config.model.latent_size}_{config.model.unet_channel}_{config.model.n_head}_{config.model.head_channel}_diffusers_unet_{config.model.checkpoint_epochs}_int8")
+
+
+def _wrap_conv2d(module, qconfig):
+    # eager mode static quantization: every Conv2d gets its own quant / dequant stubs,
+    # GroupNorm, SiLU, attention and the residual adds stay in float
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            wrapped = QuantWrapper(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            _wrap_conv2d(child, qconfig)
+
+
+def prepare_int8(unet):
+    """
+    Insert observers for static Conv2d quantization into a float UNetModel (in place).
+    Run calibration forwards afterwards, then call convert_int8.
+    """
+    unet.eval()
+    unet.clear_time_cache()
+    _wrap_conv2d(unet, get_default_qconfig(quantized_engine()))
+    return prepare(unet, inplace=True)
+
+
+def convert_int8(unet):
+    """
+    Static int8 Conv2d from the calibrated observers, dynamic int8 Linear (time MLP,
+    ResBlock time projections) and Conv1d (attention qkv / output projections).
+    """
+    convert(unet, inplace=True)
+    mapping = dict(get_default_dynamic_quant_module_mappings())
+    mapping[nn.Conv1d] = torch.ao.nn.quantized.dynamic.Conv1d
+    return quantize_dynamic(unet, {nn.Linear: default_dynamic_qconfig, nn.Conv1d: default_dynamic_qconfig},
+                            mapping=mapping, inplace=True)
+
+
+def calibrate(unet, latents, constants_dict, config):
+    """
+    Run the DDAD reverse process on train latents for every schedule validate
+    uses, so observers see the intermediate states at the timesteps actually sampled.
+    """
+    schedule = get_schedule(constants_dict, config)
+    with torch.no_grad():
+        for data in latents:
+            data = data.to(config.model.device)
+            for step_size, skip in reverse_schedules(config):
+                at = schedule.alpha_bar(step_size)
+                if config.model.noise_sampling:
+                    noisy_image = at.sqrt() * data + (1 - at).sqrt() * torch.randn_like(data)
+                else:
+                    noisy_image = data * at.sqrt() if config.model.downscale_first else data
+                # same sampler and timesteps as reconstruct_bucket in validate
+                seq = distilled_seq(step_size, skip, getattr(config.model, 'distilled_rounds', 0))
+                validate_steps(data, noisy_image, seq, unet, constants_dict['betas'], config,
+                               eta2=config.model.eta2, eta3=0, constants_dict=constants_dict, final_only=True)
+    return unet
+
+
+def load_int8_unet(unet, config):
+    """
+    Turn a freshly built float UNetModel into the int8 layout and load the
+    weights written by quantize_unet.py. Quantized kernels run on CPU only.
+    """
+    if torch.device(config.model.device).type != 'cpu':
+        raise ValueError(f"the int8 UNet runs on cpu only, got device {config.model.device}")
+    convert_int8(prepare_int8(unet))
+    unet.load_state_dict(torch.load(int8_checkpoint_path(config), map_location='cpu'))
+    return unet.eval()
@@ -0,0 +1,93 @@
+import argparse
+import copy
+import os
+import time
+from datetime import timedelta
+
+import torch
+from omegaconf import OmegaConf
+from torchmetrics import AUROC
+
+from dataset import MVTecDataset
+from main import build_model, constant, load_model
+from registry import get_vae, release, vae_key
+from sample import reverse_schedules
+from quantization import calibrate, convert_int8, int8_checkpoint_path, load_int8_unet, prepare_int8
+from recon_cache import model_hash
+from test import validate
+
+
+def parse_args():
+    cmdline_parser = argparse.ArgumentParser('D3AD int8 quantization')
+    cmdline_parser.add_argument('-cfg', '--config',
+                                default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'),
+                                help='config file')
+    cmdline_parser.add_argument('--calib_batches', type=int, default=8,
+                                help='train batches used to calibrate the Conv2d activation ranges')
+    cmdline_parser.add_argument('--skip_eval', action='store_true',
+                                help='only write the int8 weights, no AUROC / speed comparison')
+    args, unknowns = cmdline_parser.parse_known_args()
+    return args
+
+
+def train_latents(config, num_batches):
+    dataset = MVTecDataset(root=config.data.data_dir, category=config.data.category, config=config, is_train=True)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=config.data.DA_batch_size, shuffle=True,
+                                         num_workers=config.model.num_workers, drop_last=False)
+    vae = get_vae(config)
+    latents = []
+    with torch.no_grad():
+        for step, batch in enumerate(loader):
+            if step == num_batches:
+                break
+            latents.append(vae.encode(batch[0].to(config.model.device)).latent_dist.sample() * 0.18215)
+    release(vae_key(), config)
+    return latents
+
+
+def run(config, unet):
+    torch.manual_seed(42)
+    constants_dict = constant(config)
+    start = time.time()
+    results = validate(unet, constants_dict, config)
+    elapsed = time.time() - start
+    auroc = AUROC(task="binary")(torch.tensor(results['predictions']), torch.tensor(results['labels'])).item()
+    return {'auroc': auroc, 'time': elapsed}
+
+
+def main():
+    args = parse_args()
+    config = OmegaConf.load(args.config)
+    # quantized kernels are cpu only; the fp32 reference runs on the same device
+    config.model.device = 'cpu'
+    config.model.quantized = False
+    config.model.inference_dtype = 'float32'
+
+    fp32 = load_model(config)
+    print(f"calibrating on {args.calib_batches} train batches, schedules {reverse_schedules(config)}")
+    int8 = prepare_int8(copy.deepcopy(fp32))
+    calibrate(int8, train_latents(config, args.calib_batches), constant(config), config)
+    convert_int8(int8)
+    torch.save(int8.state_dict(), int8_checkpoint_path(config))
+    print(f"int8 UNet written to {int8_checkpoint_path(config)}")
+    # recon_cache and the cascade key on model_hash: the reloaded int8 UNet has to hash like the converted one
+    if model_hash(load_int8_unet(build_model(config), config)) != model_hash(int8):
+        raise RuntimeError("the reloaded int8 UNet hashes differently from the converted one")
+    if args.skip_eval:
+        return
+
+    reference = run(config, fp32)
+    del fp32, int8
+    # reload the way evaluate in main.py does with model.quantized set
+    config.model.quantized = True
+    quantized = run(config, load_model(config))
+
+    print("\n=== int8 quantization (cpu) ===")
+    print(f"{'model':<8}{'AUROC':>9}{'delta':>9}{'time':>16}{'speedup':>9}")
+    for name, row in (('fp32', reference), ('int8', quantized)):
+        print(f"{name:<8}{row['auroc']:>9.4f}{row['auroc'] - reference['auroc']:>+9.4f}"
+              f"{str(timedelta(seconds=row['time'])):>16}{reference['time'] / row['time']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
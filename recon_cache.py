@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+
+def tensor_hash(tensor):
+    """
+    Content hash of a tensor (values, shape and dtype). Quantized tensors are
+    hashed by their integer values and quantization parameters.
+    """
+    h = hashlib.sha256()
+    if tensor.is_quantized:
+        h.update(str(tensor.dtype).encode())
+        if tensor.qscheme() in (torch.per_tensor_affine, torch.per_tensor_symmetric):
+            h.update(repr((tensor.q_scale(), tensor.q_zero_point())).encode())
+        else:
+            h.update(str(tensor.q_per_channel_axis()).encode())
+            h.update(tensor_hash(tensor.q_per_channel_scales()).encode())
+            h.update(tensor_hash(tensor.q_per_channel_zero_points()).encode())
+        tensor = tensor.int_repr()
+    array = tensor.detach().cpu().contiguous().numpy()
+    h.update(str(array.shape).encode())
+    h.update(str(array.dtype).encode())
+    h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def _value_hash(value):
+    # int8 state dicts also hold packed (weight, bias) tuples and torch.dtype entries
+    if isinstance(value, torch.Tensor):
+        return tensor_hash(value)
+    if isinstance(value, (tuple, list)):
+        return hashlib.sha256(''.join(_value_hash(v) for v in value).encode()).hexdigest()
+    return hashlib.sha256(repr(value).encode()).hexdigest()
+
+
+def model_hash(model):
+    """
+    Content hash of a model's weights, used to tie cache entries to a checkpoint.
+    """
+    h = hashlib.sha256()
+    for name, value in model.state_dict().items():
+        h.update(name.encode())
+        h.update(_value_hash(value).encode())
+    return h.hexdigest()
+
+
+def sampler_params(config):
+    """
+    Sampler settings that change the reconstruction; the per-image step size and
+    skip are added to the key separately.
+    """
+    return {
+        'eta': config.model.eta,
+        'eta2': config.model.eta2,
+        'solver': getattr(config.model, 'solver', 'ddim'),
+        'distilled_rounds': getattr(config.model, 'distilled_rounds', 0),
+        'dynamic_steps': config.model.dynamic_steps,
+        'noise_sampling': config.model.noise_sampling,
+        # per-sample noise streams are keyed by seed, otherwise the global RNG draws
+        'per_sample_noise': getattr(config.model, 'per_sample_noise', False),
+        'seed': config.model.seed,
+        'downscale_first': config.model.downscale_first,
+        'early_stop': getattr(config.model, 'early_stop', False),
+        'early_stop_tol': getattr(config.model, 'early_stop_tol', None),
+        'consistency_decoder': config.model.consistency_decoder,
+        'image_size': config.data.image_size,
+        # reduced precision and NHWC kernels give numerically different latents and images
+        'inference_dtype': getattr(config.model, 'inference_dtype', 'float32'),
+        'channels_last': getattr(config.model, 'channels_last', False),
+        # a memory budget tiles encode / decode, which changes latents and images at the tile seams
+        'vae_memory_mb': getattr(config.model, 'vae_memory_mb', 0),
+        'vae_tile_overlap': getattr(config.model, 'vae_tile_overlap', 64),
+    }
+
+
+class ReconstructionCache:
+    """
+    Content-addressed on-disk cache of reconstructions.
+
+    Each entry stores the encoded input latent, the reconstructed latent and the
+    decoded image as .npy files that are read back memory-mapped. An index keeps
+    the size and last access time of every entry; once the store grows beyond
+    max_bytes the least recently used entries are evicted.
+    """
+
+    FIELDS = ('latent', 'reconstruction', 'image')
+
+    def __init__(self, cache_dir, max_bytes, model_id=''):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.model_id = model_id
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image, params):
+        payload = json.dumps({'image': tensor_hash(image), 'model': self.model_id, 'params': params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key, field):
+        return os.path.join(self.cache_dir, key[:2], f"{key}_{field}.npy")
+
+    def get(self, key):
+        """
+        Returns a dict of CPU tensors for the entry plus its 'steps_used', or
+        None on a miss.
+        """
+        if key not in self.index:
+            self.misses += 1
+            return None
+        try:
+            # copy-on-write mapping: pages are read lazily and the file is never modified
+            entry = {field: torch.from_numpy(np.load(self._path(key, field), mmap_mode='c')) for field in self.FIELDS}
+        except (OSError, ValueError):
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.index[key]['atime'] = time.time()
+        self.hits += 1
+        entry['steps_used'] = self.index[key].get('steps_used')
+        return entry
+
+    def put(self, key, latent, reconstruction, image, steps_used=None):
+        os.makedirs(os.path.dirname(self._path(key, 'latent')), exist_ok=True)
+        size = 0
+        for field, value in zip(self.FIELDS, (latent, reconstruction, image)):
+            array = value.detach().float().cpu().numpy()
+            np.save(self._path(key, field), array)
+            size += array.nbytes
+        self.index[key] = {'size': size, 'atime': time.time(), 'steps_used': steps_used}
+        self._evict()
+
+    def _remove(self, key):
+        for field in self.FIELDS:
+            try:
+                os.remove(self._path(key, field))
+            except FileNotFoundError:
+                pass
+        self.index.pop(key, None)
+
+    def _evict(self):
+        total = sum(entry['size'] for entry in self.index.values())
+        if total <= self.max_bytes:
+            return
+        for key in sorted(self.index, key=lambda k: self.index[k]['atime']):
+            total -= self.index[key]['size']
+            self._remove(key)
+            if total <= self.max_bytes:
+                break
+
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        print(f"reconstruction cache: {self.hits} hits, {self.misses} misses, {len(self.index)} entries")
@@ -0,0 +1,77 @@
+import torch
+from diffusers import AutoencoderKL
+
+from utilities import to_channels_last
+
+EVAL_VAE = ("stabilityai/sd-vae-ft-mse", None)
+TRAIN_VAE = ("stabilityai/stable-diffusion-2-1", "vae")
+
+
+class ModelRegistry:
+    """
+    Process-wide store of heavy models. A model is built by its loader on first
+    use and every later get returns the same instance, placed on the requested
+    device / dtype. Idle models can be offloaded to CPU and are moved back on
+    the next get.
+    """
+    def __init__(self):
+        self._models = {}
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def get(self, key, loader=None, device=None, dtype=None):
+        if key not in self._models:
+            if loader is None:
+                raise KeyError(f"model {key} is not loaded and has no loader")
+            self._models[key] = loader()
+        return self.place(key, device, dtype)
+
+    def put(self, key, model):
+        self._models[key] = model
+        return model
+
+    def place(self, key, device=None, dtype=None):
+        model = self._models[key]
+        placement = {name: value for name, value in (('device', device), ('dtype', dtype)) if value is not None}
+        if placement:
+            model.to(**placement)
+        return model
+
+    def offload(self, key):
+        """Move an idle model to CPU memory; it stays loaded"""
+        if key in self._models:
+            self._models[key].to('cpu')
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def drop(self, key):
+        self._models.pop(key, None)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+registry = ModelRegistry()
+
+
+def vae_key(pretrained=EVAL_VAE):
+    return f"vae:{pretrained[0]}/{pretrained[1] or ''}"
+
+
+def get_vae(config, pretrained=EVAL_VAE):
+    """AutoencoderKL from the registry, on config.model.device and in eval mode"""
+    name, subfolder = pretrained
+    def load():
+        if subfolder:
+            return AutoencoderKL.from_pretrained(name, subfolder=subfolder)
+        return AutoencoderKL.from_pretrained(name)
+    vae = registry.get(vae_key(pretrained), load, config.model.device)
+    vae = to_channels_last(vae, config)
+    vae.eval()
+    return vae
+
+
+def release(key, config):
+    """End of a stage: offload the model to CPU when config.model.offload_idle is set"""
+    if getattr(config.model, 'offload_idle', False):
+        registry.offload(key)
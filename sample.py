@@ -15,10 +15,12 @@ from forward_process import *
 def compute_adaptive_noise_scale(xt, et, at):
     """
     更穩定的自適應噪聲尺度計算
+    每個樣本各自計算一個尺度, 全程在裝置上運算 (不呼叫 .item(), 不觸發 host-device 同步)
+    回傳形狀 [N, 1, 1, 1], 可直接與 eta2 相乘後廣播
     """
-    # 使用更穩定的方法計算噪聲尺度
-    noise_energy = torch.norm(et)
-    signal_energy = torch.norm(xt)
+    # 使用更穩定的方法計算噪聲尺度 (逐樣本)
+    noise_energy = torch.linalg.vector_norm(et.flatten(1), dim=1)
+    signal_energy = torch.linalg.vector_norm(xt.flatten(1), dim=1)
     
     # 避免除零並限制縮放範圍
     signal_to_noise_ratio = signal_energy / (noise_energy + 1e-8)
@@ -26,96 +28,350 @@ def compute_adaptive_noise_scale(xt, et, at):
     # 使用雙曲正切函數進行平滑縮放
     adaptive_scale = torch.tanh(signal_to_noise_ratio * 0.1)
     
-    return max(0.5, min(1.5, adaptive_scale.item()))
+    return adaptive_scale.clamp(0.5, 1.5).view(-1, *((1,) * (xt.dim() - 1)))
 
-def my_generalized_steps(y, x, seq, model, b, config, eta2, eta3, constants_dict, eraly_stop = True):
+def ddad_correction(xt, et, y, at, eta2):
+    """
+    DDAD 誤差修正: 以條件影像 y 修正預測噪聲, 回傳 (x0_t, et_hat)
+    """
+    # 自適應噪聲調整
+    noise_scale = compute_adaptive_noise_scale(xt, et, at)
+    adaptive_eta2 = eta2 * noise_scale
+
+    yt = at.sqrt() * y + (1- at).sqrt() *  et
+
+    #DDAD error correction
+    et_hat = et - (1 - at).sqrt() * adaptive_eta2 * (yt-xt)
+
+    x0_t = (xt - et_hat * (1 - at).sqrt()) / at.sqrt()
+    return x0_t, et_hat
+
+def ddad_update(xt, et, y, at, at_next, eta2, eta, noise=None, stochastic=True):
+    """
+    單一反向步驟: DDAD 誤差修正 + DDIM 更新
+    回傳 (xt_next, x0_t); noise 為 None 時視為零 (eta = 0 的 DDIM)
+    stochastic=False 時 c1 = c2 = 0, 即 xt_next = sqrt(at_next) * x0_t
+    """
+    x0_t, et_hat = ddad_correction(xt, et, y, at, eta2)
+
+    xt_next = at_next.sqrt() * x0_t
+    if stochastic:
+        c1 = (
+            eta * ((1 - at / at_next) * (1 - at_next) / (1 - at)).sqrt()
+        )
+        c2 = ((1 - at_next) - c1 ** 2).sqrt()
+        xt_next = xt_next + c2 * et_hat
+        if noise is not None:
+            xt_next = xt_next + c1 * noise
+    return xt_next, x0_t
+
+_compiled_updates = {}
+
+def get_ddad_update(config):
+    """
+    回傳反向步驟的更新函數; config.model.compile 開啟時以 torch.compile 融合成單一 kernel
+    """
+    if not getattr(config.model, 'compile', False):
+        return ddad_update
+    backend = getattr(config.model, 'compile_backend', 'inductor')
+    if backend not in _compiled_updates:
+        enable_compile_cache(config)
+        # dynamic=None: 分組後各 bucket 的 batch 大小不同, 第二種大小出現時改以動態 batch 維度重新編譯一次, 之後不再重編
+        _compiled_updates[backend] = torch.compile(ddad_update, backend=backend, dynamic=None)
+    return _compiled_updates[backend]
+
+class DDIMSolver:
+    """
+    一階 DDIM 更新 (含 DDAD 修正), 預設的 solver
+    """
+    def __init__(self, config):
+        self.eta = config.model.eta
+        self.update = get_ddad_update(config)
+
+    def step(self, xt, et, y, at, at_next, eta2, noise=None, stochastic=True, last=False):
+        return self.update(xt, et, y, at, at_next, eta2, self.eta, noise, stochastic)
+
+class DPMSolverPP2M:
+    """
+    多步二階 DPM-Solver++ (2M, data prediction)
+    以 DDAD 修正後的 x0_t 作為資料預測, 因此保留 eta2 條件; 為確定性更新, 忽略 eta 與 noise
+    第一步與最後一步 (at_next = 1) 退化為一階
+    """
+    def __init__(self, config):
+        self.x0_prev = None
+        self.lambda_prev = None
+
+    def step(self, xt, et, y, at, at_next, eta2, noise=None, stochastic=True, last=False):
+        x0_t, _ = ddad_correction(xt, et, y, at, eta2)
+        alpha_t, sigma_t = at.sqrt(), (1 - at).sqrt()
+        alpha_next, sigma_next = at_next.sqrt(), (1 - at_next).sqrt()
+        lambda_t = torch.log(alpha_t) - torch.log(sigma_t)
+
+        if self.x0_prev is None or last:
+            d = x0_t
+        else:
+            lambda_next = torch.log(alpha_next) - torch.log(sigma_next)
+            r = (lambda_t - self.lambda_prev) / (lambda_next - lambda_t)
+            d = (1 + 0.5 / r) * x0_t - (0.5 / r) * self.x0_prev
+        self.x0_prev, self.lambda_prev = x0_t, lambda_t
+
+        # x_next = sigma_next / sigma_t * x_t - alpha_next * (exp(-h) - 1) * d, h = lambda_next - lambda_t
+        # 展開 exp(-h) 後在 sigma_next = 0 時仍為有限值
+        xt_next = (sigma_next / sigma_t) * xt + (alpha_next - alpha_t * sigma_next / sigma_t) * d
+        return xt_next, x0_t
+
+SOLVERS = {
+    'ddim': DDIMSolver,
+    'dpmsolver++': DPMSolverPP2M,
+}
+
+def build_solver(config):
+    """依 config.model.solver 建立反向過程的 solver (預設 ddim)"""
+    name = getattr(config.model, 'solver', 'ddim')
+    if name not in SOLVERS:
+        raise ValueError(f"unknown solver: {name}, choose from {list(SOLVERS)}")
+    return SOLVERS[name](config)
+
+class ConvergenceMonitor:
+    """
+    逐樣本的提前終止判斷: 連續兩步 x0_t 的相對變化小於 tol 時該樣本視為收斂,
+    之後凍結其 x0 估計; 全部收斂時取樣器即可停止
+    """
+    def __init__(self, n, total_steps, tol, device):
+        self.tol = tol
+        self.done = torch.zeros(n, dtype=torch.bool, device=device)
+        self.steps_used = torch.full((n,), total_steps, dtype=torch.long, device=device)
+        self.x0_prev = None
+        self.x0_frozen = None
+
+    def update(self, step, x0_t):
+        """記錄第 step 步 (0 起算) 的 x0_t, 全部樣本收斂時回傳 True"""
+        if self.x0_prev is None:
+            self.x0_prev = x0_t
+            self.x0_frozen = x0_t
+            return False
+        delta = torch.linalg.vector_norm((x0_t - self.x0_prev).flatten(1), dim=1)
+        delta = delta / (torch.linalg.vector_norm(self.x0_prev.flatten(1), dim=1) + 1e-8)
+        newly_done = (delta < self.tol) & ~self.done
+        self.steps_used = torch.where(newly_done, torch.full_like(self.steps_used, step + 1), self.steps_used)
+        self.x0_frozen = torch.where(self.done.view(-1, *((1,) * (x0_t.dim() - 1))), self.x0_frozen, x0_t)
+        self.done = self.done | newly_done
+        self.x0_prev = x0_t
+        return bool(self.done.all())
+
+    def finalize(self, xt):
+        """已收斂樣本回傳凍結的 x0 估計, 其餘樣本回傳最後的 xt"""
+        if self.x0_frozen is None:
+            return xt, xt
+        mask = self.done.view(-1, *((1,) * (xt.dim() - 1)))
+        return torch.where(mask, self.x0_frozen, xt), self.x0_frozen
+
+class TrajectoryRecorder:
+    """
+    記錄反向採樣軌跡的回呼函數 (opt-in)
+    每一步把 xt_next 與 x0_t 複製到 CPU, 只在需要完整軌跡時使用
+    """
+    def __init__(self, x=None, device='cpu'):
+        self.device = device
+        self.xs = [] if x is None else [x]
+        self.x0_preds = []
+
+    def __call__(self, step, xt_next, x0_t):
+        self.xs.append(xt_next.to(self.device))
+        self.x0_preds.append(x0_t.to(self.device))
+
+def time_cache_model(model, config, timesteps):
+    """
+    UNetModel (非 DataParallel / torch.compile 包裝) 時預先快取 timesteps 的時間嵌入與各 ResBlock 的投影,
+    回傳 model_fn(xt, t, ts), ts 為每個樣本的整數 timestep; 其餘情況直接呼叫 model(xt, t)
+    config.model.time_cache = False 可關閉
+    """
+    if not getattr(config.model, 'time_cache', True) or not callable(getattr(type(model), 'cache_timesteps', None)):
+        return lambda xt, t, ts: model(xt, t)
+    model.cache_timesteps(timesteps)
+    return lambda xt, t, ts: model(xt, t, timesteps=ts)
+
+
+def my_generalized_steps(y, x, seq, model, b, config, eta2, eta3, constants_dict, eraly_stop = False, final_only = False, callback = None, stats = None, noise_provider = None, sample_ids = None):
+    """
+    DDAD 條件反向採樣
+    final_only=True 時狀態全程留在運算裝置上, 只回傳最後的 (xt, x0_t);
+    需要軌跡時傳入 callback(step, xt_next, x0_t), 例如 TrajectoryRecorder
+    eraly_stop=True 時逐樣本檢查 x0_t 是否收斂 (config.model.early_stop_tol), 全部收斂即提前結束;
+    傳入 stats (dict) 時寫入 stats['steps_used'], 為每張影像實際使用的步數
+    傳入 noise_provider 與 sample_ids 時, 每個樣本的噪聲由 (seed, sample id, t) 決定, 與 batch 組成無關
+    """
+    if not final_only:
+        recorder = TrajectoryRecorder(x)
+        xt, x0_t = my_generalized_steps(y, x, seq, model, b, config, eta2, eta3, constants_dict, eraly_stop, final_only=True, callback=_chain_callbacks(recorder, callback), stats=stats, noise_provider=noise_provider, sample_ids=sample_ids)
+        return recorder.xs, recorder.x0_preds
+
+    schedule = get_schedule(constants_dict, config, b)
+    solver = build_solver(config)
     with torch.no_grad():
         n = x.size(0)
         
-        m = seq[0].size(0)  # Length of each sequence
-        x0_preds = []
-        xs = [x]
+        m = len(seq[0])  # Length of each sequence
+        xt = to_channels_last(x.to(config.model.device), config)
+        x0_t = xt
+        monitor = ConvergenceMonitor(n, m, getattr(config.model, 'early_stop_tol', 1e-3), xt.device) if eraly_stop else None
+        model_fn = time_cache_model(model, config, [int(v) for s in seq for v in s])
         
         for idx in reversed(range(m)):
-            t = torch.tensor([s[idx] for s in seq]).to(config.model.device)
+            ts = [int(s[idx]) for s in seq]
+            t = torch.tensor(ts, device=xt.device)
             if idx == 0:
-                next_t = torch.full((n,), -1, device=x.device, dtype=torch.long)
+                next_t = torch.full((n,), -1, device=xt.device, dtype=torch.long)
             else:
-                next_t = torch.tensor([s[idx-1] for s in seq]).to(x.device)
+                next_t = torch.tensor([int(s[idx-1]) for s in seq], device=xt.device)
             
-            at = compute_alpha2(b, t.long(), config)
-            at_next = compute_alpha2(b, next_t.long(),config)
-
-            xt = xs[-1].to(config.model.device)
+            at = schedule.alpha_bar(t)
+            at_next = schedule.alpha_bar(next_t)
             
-            et = model(xt, t)
+            et = model_fn(xt, t, ts)
             
-            # 自適應噪聲調整
-            noise_scale = compute_adaptive_noise_scale(xt, et, at)
-            adaptive_eta2 = eta2 * noise_scale
-
-            yt = at.sqrt() * y + (1- at).sqrt() *  et
-
-            #DDAD error correction
-            et_hat = et - (1 - at).sqrt() * adaptive_eta2 * (yt-xt)
+            noise = None
+            if config.model.eta:
+                noise = noise_provider.randn_like(xt, sample_ids, ts) if noise_provider is not None else torch.randn_like(xt)
+            xt, x0_t = solver.step(xt, et, y, at, at_next, eta2, noise, last=idx == 0)
 
-            x0_t = (xt - et_hat * (1 - at).sqrt()) / at.sqrt()
+            if callback is not None:
+                callback(m - 1 - idx, xt, x0_t)
 
-            x0_preds.append(x0_t.to('cpu')) 
+            if monitor is not None and monitor.update(m - 1 - idx, x0_t):
+                break
 
-            c1 = (
-                config.model.eta * ((1 - at / at_next) * (1 - at_next) / (1 - at)).sqrt()
-            )
-            c2 = ((1 - at_next) - c1 ** 2).sqrt()
+        if monitor is not None:
+            xt, x0_t = monitor.finalize(xt)
+        if stats is not None:
+            stats['steps_used'] = monitor.steps_used if monitor is not None else torch.full((n,), m, dtype=torch.long, device=xt.device)
 
-            xt_next = at_next.sqrt() * x0_t + c1 * torch.randn_like(x) + c2 * et_hat
+    return xt, x0_t
 
-            xs.append(xt_next.to('cpu'))
-
-    return xs, x0_preds
+def DA_generalized_steps(y, x, seq, model, b, config, eta2, eta3, constants_dict, eraly_stop = False, final_only = False, callback = None, stats = None, noise_provider = None, sample_ids = None):
+    """
+    Domain adaptation 用的 DDAD 反向採樣, final_only / callback / eraly_stop / stats / noise_provider 語意同 my_generalized_steps
+    """
+    if not final_only:
+        recorder = TrajectoryRecorder(x)
+        xt, x0_t = DA_generalized_steps(y, x, seq, model, b, config, eta2, eta3, constants_dict, eraly_stop, final_only=True, callback=_chain_callbacks(recorder, callback), stats=stats, noise_provider=noise_provider, sample_ids=sample_ids)
+        return recorder.xs, recorder.x0_preds
 
-def DA_generalized_steps(y, x, seq, model, b, config, eta2, eta3, constants_dict, eraly_stop = True):
+    schedule = get_schedule(constants_dict, config, b)
+    solver = build_solver(config)
     with torch.no_grad():
         n = x.size(0)
         seq_next = [-1] + list(seq[:-1])
-        x0_preds = []
-        
-        xs = [x]
+        xt = to_channels_last(x.to(config.model.device), config)
+        x0_t = xt
+        monitor = ConvergenceMonitor(n, len(seq), getattr(config.model, 'early_stop_tol', 1e-3), xt.device) if eraly_stop else None
+        model_fn = time_cache_model(model, config, seq)
         
         for index, (i, j) in enumerate(zip(reversed(seq), reversed(seq_next))):
-            t = (torch.ones(n) * i).to(x.device)
-            t_one = (torch.ones(n)).to(x.device)
-            next_t = (torch.ones(n) * j).to(x.device)
-            at = compute_alpha(b, t.long(), config)
-            at_half = compute_alpha(b,(t/2).long(), config)
-            at_next = compute_alpha(b, next_t.long(),config)
-            xt = xs[-1].to(config.model.device)
-            
-            et = model(xt, t)
+            t = torch.full((n,), float(i), device=xt.device)
+            at = schedule.alpha_bar(i)
+            at_next = schedule.alpha_bar(j)
             
-            # 自適應噪聲調整
-            noise_scale = compute_adaptive_noise_scale(xt, et, at)
-            adaptive_eta2 = eta2 * noise_scale
+            et = model_fn(xt, t, [int(i)] * n)
             
-            yt = at.sqrt() * y + (1- at).sqrt() *  et
+            # 第一步不加隨機項 (c1 = c2 = 0)
+            noise = None
+            if config.model.eta and index > 0:
+                noise = noise_provider.randn_like(xt, sample_ids, i) if noise_provider is not None else torch.randn_like(xt)
+            xt, x0_t = solver.step(xt, et, y, at, at_next, eta2, noise, stochastic=index > 0, last=j == -1)
 
-            et_hat = et - (1 - at).sqrt() * adaptive_eta2 * (yt-xt)
+            if callback is not None:
+                callback(index, xt, x0_t)
 
-            
-            x0_t = (xt - et_hat * (1 - at).sqrt()) / at.sqrt()
+            if monitor is not None and monitor.update(index, x0_t):
+                break
 
-            x0_preds.append(x0_t.to('cpu')) 
-            if index == 0:
-                c1 = torch.zeros_like(x0_t)
-                c2 = torch.zeros_like(x0_t)
-            else:
-                c1 = (
-                    config.model.eta * ((1 - at / at_next) * (1 - at_next) / (1 - at)).sqrt()
-                )
-                c2 = ((1 - at_next) - c1 ** 2).sqrt()
-            
-            xt_next = at_next.sqrt() * x0_t + c1 * torch.randn_like(x) + c2 * et_hat
+        if monitor is not None:
+            xt, x0_t = monitor.finalize(xt)
+        if stats is not None:
+            stats['steps_used'] = monitor.steps_used if monitor is not None else torch.full((n,), len(seq), dtype=torch.long, device=xt.device)
+
+    return xt, x0_t
+
+def validate_steps(y, x, seq, model, b, config, **kwargs):
+    """
+    validate 所用的反向採樣: dynamic_steps 時為 my_generalized_steps (seq 複製給每個樣本, 每一步都含隨機項),
+    否則為 DA_generalized_steps (第一步確定性); 其餘參數同兩者
+    """
+    if config.model.dynamic_steps:
+        return my_generalized_steps(y, x, [seq] * x.size(0), model, b, config, **kwargs)
+    return DA_generalized_steps(y, x, seq, model, b, config, **kwargs)
+
+def first_step_stochastic(config):
+    """validate_steps 的第一步是否含隨機項 (c1, c2)"""
+    return bool(config.model.dynamic_steps)
+
+def reverse_schedules(config):
+    """
+    validate 可能使用的 (step_size, skip) 組合: dynamic_steps 時為每個 KNN bin 的步長, 否則為固定的 test_trajectoy_steps / skip
+    """
+    if not config.model.dynamic_steps:
+        return [(int(config.model.test_trajectoy_steps), int(config.model.skip))]
+    # 與 validate 相同的 bin -> (step_size, skip) 對應
+    step_size, skip = steps_from_bins(np.arange(10), config)
+    return sorted(set(zip(step_size.astype(int).tolist(), skip.astype(int).tolist())))
+
+def distilled_seq(step_size, skip, rounds=0):
+    """
+    progressive distillation 經過 rounds 輪後的反向時間步: 由最高的時間步起, 每 2**rounds 個取一個
+    rounds = 0 時即 range(0, step_size, skip)
+    """
+    seq = list(range(0, step_size, skip))
+    return seq[::-1][::2 ** rounds][::-1]
+
+class StepSizeBucketScheduler:
+    """
+    將測試影像依 KNN 選出的 (step_size, skip) 分組, 每組湊滿 batch_size 就以一次批次反向採樣執行
+    run_fn(items, step_size, skip) 回傳與 items 對齊的結果列表
+    add / complete / flush 依原始順序 (index) 回傳已完成的項目, 每個項目加上 'reconstruction'
+    """
+    def __init__(self, run_fn, batch_size):
+        self.run_fn = run_fn
+        self.batch_size = max(int(batch_size), 1)
+        self.buckets = {}
+        self.finished = {}
+        self.next_index = 0
+
+    def add(self, index, item, step_size, skip):
+        key = (int(step_size), int(skip))
+        bucket = self.buckets.setdefault(key, [])
+        bucket.append((index, item))
+        if len(bucket) >= self.batch_size:
+            self._run(key)
+        return self._pop_in_order()
+
+    def complete(self, index, item):
+        """登記已有結果的項目 (例如快取命中), 不經反向採樣但保持原始順序"""
+        self.finished[index] = item
+        return self._pop_in_order()
+
+    def flush(self):
+        for key in list(self.buckets):
+            self._run(key)
+        return self._pop_in_order()
+
+    def _run(self, key):
+        bucket = self.buckets.pop(key)
+        outputs = self.run_fn([item for _, item in bucket], *key)
+        for (index, item), output in zip(bucket, outputs):
+            item['reconstruction'] = output
+            self.finished[index] = item
 
-            xs.append(xt_next.to('cpu'))
+    def _pop_in_order(self):
+        ready = []
+        while self.next_index in self.finished:
+            ready.append(self.finished.pop(self.next_index))
+            self.next_index += 1
+        return ready
 
-    return xs, x0_preds
\ No newline at end of file
+def _chain_callbacks(*callbacks):
+    callbacks = [cb for cb in callbacks if cb is not None]
+    def chained(step, xt_next, x0_t):
+        for cb in callbacks:
+            cb(step, xt_next, x0_t)
+    return chained
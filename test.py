@@ -9,7 +9,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from diffusers import AutoencoderKL
-from sklearn.neighbors import NearestNeighbors
 from typing import Tuple, List, Dict, Any, Optional
 
 # 自己寫的模組（請確認路徑正確）
@@ -20,6 +19,11 @@ from dataset import *
 from visualize import *
 from anomaly_map import *
 from metrics import metric
+from registry import get_vae, release, vae_key
+from chunked_vae import bounded_vae
+from cascade import ANOMALOUS, GOOD, LatentCascade, calibration_path, latent_score, load_calibration, save_calibration
+from product_quantization import PCAProjection, ProductQuantizer, RandomProjection
+from recon_cache import ReconstructionCache, model_hash, sampler_params
 from feature_extractor import *
 from consistencydecoder import ConsistencyDecoder
 
@@ -28,50 +32,195 @@ from consistencydecoder import ConsistencyDecoder
 # KNN 類別及相關函數
 # =============================================================================
 class KNN:
+    """
+    Exact k nearest neighbours with the memory bank kept on config.model.device.
+    Queries run in chunks of config.model.knn_chunk_size bank rows: one matrix
+    multiply (euclidean, sqeuclidean, cosine) or cdist (manhattan, chebyshev)
+    per chunk, merged with a running top-k. fit builds the histogram of the
+    mean k-NN distance of every train sample (itself included), as before.
+    """
+    METRICS = {
+        'l2': 'euclidean', 'euclidean': 'euclidean', 'sqeuclidean': 'sqeuclidean',
+        'cosine': 'cosine', 'l1': 'manhattan', 'manhattan': 'manhattan', 'cityblock': 'manhattan',
+        'chebyshev': 'chebyshev', 'infinity': 'chebyshev',
+    }
+
     def __init__(self, config, k=5, num_bins=10):
         self.k = k
         self.config = config
-        self.model = NearestNeighbors(
-            n_neighbors=k,
-            metric=getattr(config.model, 'KNN_metric', 'euclidean'),
-            n_jobs=-1
-        )
+        metric = getattr(config.model, 'KNN_metric', 'euclidean')
+        if metric not in self.METRICS:
+            raise ValueError(f"unsupported KNN metric: {metric}, choose from {list(self.METRICS)}")
+        self.metric = self.METRICS[metric]
+        self.chunk_size = getattr(config.model, 'knn_chunk_size', 1024)
         self.num_bins = num_bins
         self.histogram = None
         self.bin_edges = None
+        self.bank = None
 
     def fit(self, X):
-        if isinstance(X, torch.Tensor):
-            X = X.detach().cpu().numpy()
-        X = X.reshape(X.shape[0], -1)
-
-        self.model.fit(X)
-        distances, _ = self.model.kneighbors(X)
-        avg_distances = distances.mean(axis=1)
-
-        self.histogram, self.bin_edges = np.histogram(
-            avg_distances,
-            bins=self.num_bins,
-            density=True
-        )
+        X = torch.as_tensor(X, device=self.config.model.device).float()
+        self._build(X.reshape(X.shape[0], -1))
+
+        distances, _ = self.transform(X)
+        avg_distances = distances.mean(dim=1)
+
+        # np.histogram(avg_distances, bins=num_bins, density=True), computed on the device
+        low, high = avg_distances.min().item(), avg_distances.max().item()
+        if low == high:
+            # all distances equal: numpy widens the range to (low - 0.5, high + 0.5), one bin holds every sample
+            low, high = low - 0.5, high + 0.5
+        edges = torch.linspace(low, high, self.num_bins + 1, device=avg_distances.device)
+        counts = torch.histc(avg_distances, bins=self.num_bins, min=low, max=high)
+        self.histogram = (counts / (counts.sum() * (edges[1:] - edges[:-1]))).cpu().numpy()
+        self.bin_edges = edges.double().cpu().numpy()
 
         print(f"bin edges: {self.bin_edges}")
         print(f"histogram: {self.histogram}")
 
+    def _build(self, X):
+        self.bank = self._prepare(X)
+        self._bank_sq_norms = (self.bank * self.bank).sum(dim=1)
+
+    def transform(self, X):
+        """(distances, indices) of the k nearest bank rows, ascending, as tensors on the bank's device"""
+        X = torch.as_tensor(X, device=self.bank.device).float()
+        queries = self._prepare(X.reshape(X.shape[0], -1))
+        query_sq_norms = (queries * queries).sum(dim=1)
+        return self._nearest(queries.shape[0], self.bank.shape[0], queries.device, lambda start, end: self._distances(
+            queries, query_sq_norms, self.bank[start:end], self._bank_sq_norms[start:end]))
+
+    def _nearest(self, num_queries, num_rows, device, chunk_distances):
+        # running top-k over chunk_distances(start, end), [num_queries, end - start] per chunk
+        k = min(self.k, num_rows)
+        best_distances = torch.empty(num_queries, 0, device=device)
+        best_indices = torch.empty(num_queries, 0, dtype=torch.long, device=device)
+        for start in range(0, num_rows, self.chunk_size):
+            end = min(start + self.chunk_size, num_rows)
+            distances = chunk_distances(start, end)
+            indices = torch.arange(start, end, device=device).expand(num_queries, -1)
+            best_distances, order = torch.cat([best_distances, distances], dim=1).topk(k, dim=1, largest=False, sorted=True)
+            best_indices = torch.cat([best_indices, indices], dim=1).gather(1, order)
+        return best_distances, best_indices
+
+    def _prepare(self, X):
+        # cosine distance is a matmul of unit vectors
+        if self.metric == 'cosine':
+            return F.normalize(X, dim=1)
+        return X
+
+    def _distances(self, queries, query_sq_norms, chunk, chunk_sq_norms):
+        if self.metric == 'cosine':
+            return 1 - queries @ chunk.T
+        if self.metric in ('euclidean', 'sqeuclidean'):
+            distances = (query_sq_norms[:, None] - 2 * queries @ chunk.T + chunk_sq_norms[None, :]).clamp_(min=0)
+            return distances.sqrt_() if self.metric == 'euclidean' else distances
+        return torch.cdist(queries, chunk, p=1 if self.metric == 'manhattan' else float('inf'))
+
+    def nbytes(self):
+        """Size of the stored memory bank"""
+        return self.bank.numel() * self.bank.element_size()
+
+    def to(self, device):
+        """Moves the memory bank (and any compression state) to `device`; queries run there"""
+        for name, value in self.__dict__.items():
+            if name != 'config' and (isinstance(value, torch.Tensor) or callable(getattr(value, 'to', None))):
+                setattr(self, name, value.to(device))
+        return self
+
+    def __getstate__(self):
+        # pickles load on machines without the fitting device
+        return {name: value.cpu() if isinstance(value, torch.Tensor) else value for name, value in self.__dict__.items()}
+
+    def __setstate__(self, state):
+        # back on the compute device, unless that is a GPU this machine does not have
+        self.__dict__.update(state)
+        device = torch.device(self.config.model.device)
+        if device.type != 'cuda' or torch.cuda.is_available():
+            self.to(device)
+
+
+class CompressedKNN(KNN):
+    """
+    KNN over a compressed memory bank (config.model.knn_compression): rows are
+    projected to knn_projection_dim dimensions (random or pca) and stored as
+    product quantization codes of knn_pq_subspaces bytes. Queries are
+    projected but not quantized; their distances to the codes come from
+    per-subspace lookup tables (asymmetric distance computation). Supports the
+    euclidean, sqeuclidean and cosine metrics; for cosine the projected
+    vectors are renormalized to unit length before quantization and queries.
+    """
+    def __init__(self, config, k=5, num_bins=10):
+        super().__init__(config, k, num_bins)
+        if self.metric not in ('euclidean', 'sqeuclidean', 'cosine'):
+            raise ValueError(f"compressed KNN supports euclidean, sqeuclidean and cosine, not {self.metric}")
+        self.compression = config.model.knn_compression
+        if self.compression not in ('random', 'pca'):
+            raise ValueError(f"unsupported KNN compression: {self.compression}, choose from none, random, pca")
+        self.projection = None
+        self.quantizer = None
+        self.codes = None
+
+    def _build(self, X):
+        X = self._prepare(X)
+        dim = self.config.model.knn_projection_dim
+        if self.compression == 'pca':
+            self.projection = PCAProjection.fit(X, dim)
+        else:
+            self.projection = RandomProjection(X.shape[1], dim, seed=self.config.model.seed)
+        projected = self._project(X)
+        self.quantizer = ProductQuantizer(self.config.model.knn_pq_subspaces, self.config.model.knn_pq_bits,
+                                          seed=self.config.model.seed).fit(projected)
+        self.codes = self.quantizer.encode(projected)
+
     def transform(self, X):
-        if isinstance(X, torch.Tensor):
-            X = X.detach().cpu().numpy()
-        X = X.reshape(X.shape[0], -1)
-        return self.model.kneighbors(X)
+        X = torch.as_tensor(X, device=self.codes.device).float()
+        tables = self.quantizer.distance_tables(self._project(self._prepare(X.reshape(X.shape[0], -1))))
+        return self._nearest(X.shape[0], self.codes.shape[0], X.device,
+                             lambda start, end: self._from_squared(ProductQuantizer.adc(tables, self.codes[start:end])))
+
+    def _project(self, X):
+        # a projection does not keep unit length; renormalized, |a - b|^2 / 2 is the cosine distance of the projections
+        if self.metric == 'cosine':
+            return F.normalize(self.projection(X), dim=1)
+        return self.projection(X)
+
+    def _from_squared(self, distances):
+        # unit vectors: |a - b|^2 = 2 - 2 cos(a, b), up to the quantization error
+        if self.metric == 'cosine':
+            return distances / 2
+        return distances.clamp_(min=0).sqrt_() if self.metric == 'euclidean' else distances
+
+    def nbytes(self):
+        return self.codes.numel() * self.codes.element_size() + self.quantizer.nbytes() + self.projection.nbytes()
+
+
+def build_knn(config):
+    """Exact KNN, or CompressedKNN when config.model.knn_compression is random or pca"""
+    if getattr(config.model, 'knn_compression', 'none') in (None, 'none'):
+        return KNN(config=config, k=config.model.knn_k, num_bins=10)
+    return CompressedKNN(config=config, k=config.model.knn_k, num_bins=10)
+
+
+def get_bin_ids(knn, distances):
+    """Histogram bin of every query's mean k-NN distance; stays on the device for tensors"""
+    if isinstance(distances, torch.Tensor):
+        edges = torch.as_tensor(knn.bin_edges, dtype=distances.dtype, device=distances.device)
+        # bucketize(right=True) is np.digitize
+        bin_ids = torch.bucketize(distances.mean(dim=1), edges, right=True) - 1
+        return bin_ids.clamp(max=len(knn.bin_edges) - 2)
+    avg_distances = distances.mean(axis=1)
+    bin_ids = np.digitize(avg_distances, knn.bin_edges) - 1
+    return np.minimum(bin_ids, len(knn.bin_edges) - 2)
 
 
 def get_bins_and_mappings(knn, distances, indices):
     mappings = []
     keys = []
 
-    avg_distances = distances.mean(axis=1)
-    bin_ids = np.digitize(avg_distances, knn.bin_edges) - 1
-    bin_ids = np.minimum(bin_ids, len(knn.bin_edges) - 2)
+    bin_ids = get_bin_ids(knn, distances)
+    if isinstance(bin_ids, torch.Tensor):
+        bin_ids, indices = bin_ids.cpu().numpy(), indices.cpu().numpy()
 
     for i in range(len(distances)):
         bin_id = int(bin_ids[i])
@@ -82,6 +231,41 @@ def get_bins_and_mappings(knn, distances, indices):
     return mappings, keys
 
 
+def knn_features(feature_extractor, images, config):
+    """
+    KNN descriptor of every image: the selected feature maps pooled to 16x16,
+    flattened and concatenated. Stays on the device.
+    """
+    knn_transform = transforms.Compose([
+                transforms.Lambda(lambda t: (t + 1) / (2)),
+                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+            ])
+    images = to_channels_last(knn_transform(images), config)
+    with inference_autocast(config):
+        features = [f.float() for f in feature_extractor(images.to(config.model.device))]
+    pooled_features = [F.adaptive_avg_pool2d(features[i], (16, 16)) for i in config.model.selected_features]
+    return torch.cat([pf.reshape(pf.size(0), -1) for pf in pooled_features], dim=1).detach()
+
+
+def fit_knn(feature_extractor, loader, config):
+    """build_knn fitted on the knn_features of every image in loader"""
+    knn = build_knn(config)
+    # We're going to stack the extracted features of the training data here
+    train_stack = []
+    for i, train_batch in enumerate(loader):
+        train_stack.append(knn_features(feature_extractor, train_batch[0], config))
+        torch.cuda.empty_cache()
+    knn.fit(torch.cat(train_stack, dim=0))
+    return knn
+
+
+def knn_steps(knn, feature_extractor, images, config):
+    """(step_size, skip) arrays validate picks for images from their KNN histogram bins"""
+    # features stay on the device, only the chosen bins come back
+    distances, indices = knn.transform(knn_features(feature_extractor, images, config))
+    return steps_from_bins(get_bin_ids(knn, distances).cpu().numpy(), config)
+
+
 # =============================================================================
 # validate 函數：驗證流程與後處理
 # =============================================================================
@@ -135,6 +319,8 @@ def validate(unet, constants_dict, config):
     anomaly_map_recon_list = []
     anomaly_map_feature_list = []
     anomaly_map_latent_list = []
+    steps_used_list = []
+    cascade_list = []
 
 
     if config.model.latent:
@@ -143,70 +329,27 @@ def validate(unet, constants_dict, config):
         if config.model.latent_backbone == "VAE":
             
             
-            vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse")
-            vae.to(config.model.device)
+            vae = bounded_vae(get_vae(config), config)
             if config.model.consistency_decoder:
                 consistency_decoder = ConsistencyDecoder(device=config.model.device)
             else:
                 consistency_decoder = False
-            vae.eval()
         else:
             print("Error backbone needs to be VAE")
 
         if config.model.dynamic_steps or (config.model.distance_metric_eval == "combined"):
         
-            #FE backbone
-            if config.model.fe_backbone == "wide_resnet50":
-                feature_extractor = wide_resnet50_2(pretrained=True)[0]
-            elif config.model.fe_backbone == "resnet34":
-                feature_extractor = resnet34(pretrained=True)[0]
-            elif config.model.fe_backbone == "resnet101":
-                feature_extractor = resnet101(pretrained=True)[0]
-            elif config.model.fe_backbone == "wide_resnet101":
-                feature_extractor = wide_resnet101_2(pretrained=True)[0]
-            else:
-                print("error: no valid fe backbone selected")
-            feature_extractor.to(config.model.device)
-            feature_extractor = Domain_adaptation(unet, feature_extractor,vae, config, fine_tune=config.model.DA_fine_tune, constants_dict=constants_dict,dataloader=trainloader, consistency_decoder=consistency_decoder)   
-            feature_extractor.eval()
+            #FE backbone, ImageNet weights as the starting point of domain adaptation
+            feature_extractor = adapted_feature_extractor(unet, vae, config, constants_dict, trainloader, consistency_decoder)
             
 
-            knn_transform = transforms.Compose([
-                        transforms.Lambda(lambda t: (t + 1) / (2)),
-                        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-                    ])
-
-            knn = KNN(config=config,k=config.model.knn_k,num_bins=10)
-
-            # We're going to stack the extracted features of the training data here
-            train_stack = []
+            # the VAE is idle while the KNN is fitted
+            release(vae_key(), config)
             
-            del vae
-            torch.cuda.empty_cache()
-            
-            for i, train_batch in enumerate(trainloader):
-                
-                train_batch = knn_transform(train_batch[0])
-                
-                train_batch = feature_extractor(train_batch.to(config.model.device))
-                selected_features = [train_batch[i] for i in config.model.selected_features]
-                common_size = (16,16)
-                # Use adaptive pooling to resize feature maps to the common size
-                adaptive_pool = nn.AdaptiveAvgPool2d(common_size)
-                pooled_features = [adaptive_pool(feature_map) for feature_map in selected_features]
-
-                # Flatten each feature map in the batch and concatenate along the feature dimension
-                flattened_features = [pf.view(pf.size(0), -1) for pf in pooled_features]  # Flatten each feature map
-                train_batch = torch.cat(flattened_features, dim=1)  # Concatenate along the feature dimension
-                
-                train_stack.append(train_batch.detach().cpu())
-                torch.cuda.empty_cache()
-                
             # fit KNN model on training data
-            knn.fit(torch.cat(train_stack, dim=0))
+            knn = fit_knn(feature_extractor, trainloader, config)
 
             knnPickle = open(os.path.join(os.path.join(os.getcwd(), config.model.checkpoint_dir), config.data.category,f"knn_{config.model.knn_k}_{config.model.DA_epochs}"), 'wb') 
-            del train_stack
             del trainloader
             torch.cuda.empty_cache()
             # source, destination 
@@ -218,137 +361,268 @@ def validate(unet, constants_dict, config):
       
 
     
-    def roundup(x, n=10):
-        res = np.ceil(x/n)*n
-        mask = np.logical_and(x % n < n/2, x % n > 0)
-        res[mask] -= n
-        return res
-    
 
 
     if config.model.latent_backbone == "VAE":
-        vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse")
-        vae.to(config.model.device)
-
-        vae.eval()     
+        # same instance as above, moved back if it was offloaded
+        vae = bounded_vae(get_vae(config), config)
 
     #eval    
     if config.data.name == 'BTAD' or config.data.name == "VisA" or config.data.name == "MVTec":
         
-        with torch.no_grad():
-            start = time.time()
-            for step, (data, targets, labels, filename) in enumerate(testloader):
-                
-                
-                data_placeholder = data
-                
-                if config.model.dynamic_steps:
-
-                    #extract features and peform KNN on training set to determine noise level
-
-                    test_batch = data
-                    test_batch = knn_transform(test_batch)
-                    test_batch = feature_extractor(test_batch.to(config.model.device))
-                    selected_features = [test_batch[i] for i in config.model.selected_features]
-                    adaptive_pool = nn.AdaptiveAvgPool2d(common_size)
-                    pooled_features = [adaptive_pool(feature_map) for feature_map in selected_features]
-
-                    flattened_features = [pf.view(pf.size(0), -1) for pf in pooled_features] 
-                    test_batch = torch.cat(flattened_features, dim=1)
-
-                    test_batch = test_batch.detach().cpu().numpy()
-                    torch.cuda.empty_cache()
-
-                    distances, indices = knn.transform(test_batch)
-                
-                    mappings, keys = get_bins_and_mappings(knn, distances, indices)
-
-                    mapping_int = int(list(set(mappings[0].keys()))[0])
-
-                    bin_ids_array = np.array(keys)
-
-                    # Compute step_sizes directly using element-wise operations
-                    step_sizes_array = np.maximum(bin_ids_array, 2) / 10 * config.model.test_trajectoy_steps
-                    step_size = roundup(step_sizes_array)
-
-                    # Compute skips directly using element-wise operations
-                    skip = np.maximum(step_size / 10, 1).astype(int)
-            
-                    step_list.extend(step_size)
-                    
-                    
+        schedule = get_schedule(constants_dict, config)
+        early_stop = getattr(config.model, 'early_stop', False)
+        # per-image noise streams keyed by test set index, identical for any batching
+        noise_provider = NoiseProvider.from_config(config)
+
+        def select_steps(data):
+            # per-image (step_size, skip) arrays for a batch of images
+            if not config.model.dynamic_steps:
+                return np.full(data.shape[0], config.model.test_trajectoy_steps), np.full(data.shape[0], config.model.skip)
+
+            #extract features and peform KNN on training set to determine noise level
+            return knn_steps(knn, feature_extractor, data, config)
+
+        def encode_items(items):
+            # VAE latents of the items' images, stored as item['latent']
+            if not items:
+                return
+            data = to_channels_last(torch.cat([item['image'] for item in items], dim=0).to(config.model.device), config)
+            if config.model.latent:
+                with inference_autocast(config):
+                    latent_dist = vae.encode(data).latent_dist
+                    if noise_provider is not None:
+                        data = noise_provider.sample_latent(latent_dist, [item['id'] for item in items])
+                    else:
+                        data = latent_dist.sample()
+                data = data.float() * 0.18215    
+            for item, latent in zip(items, data.split(1, dim=0)):
+                item['latent'] = latent
+
+        def reconstruct_bucket(items, step_size, skip):
+            # one batched reverse pass for images that share (step_size, skip)
+            data = torch.cat([item['latent'] for item in items], dim=0)
+            sample_ids = [item['id'] for item in items]
+            at = schedule.alpha_bar(step_size)
+
+            if config.model.noise_sampling:
+                if noise_provider is not None:
+                    noise = noise_provider.randn_like(data, sample_ids, step_size, stream=2)
                 else:
-                    step_size = config.model.test_trajectoy_steps
-                    skip = config.model.skip
-                    
-                filename_list.append(filename)
-                forward_list_orig.append(data)
-                forward_list.append(data)
-                if config.model.latent:
-                    data = data.to(config.model.device)
-                    data = vae.encode(data).latent_dist.sample() * 0.18215    
-                
-            
-                test_trajectoy_steps = torch.Tensor([step_size]).type(torch.int64).to(config.model.device)[0]
-                
-                
-                at = compute_alpha2(constants_dict['betas'], test_trajectoy_steps.long(),config)
-
-                if config.model.noise_sampling:
                     noise = torch.randn_like(data).to(config.model.device)
-                    noisy_image = at.sqrt() * data + (1- at).sqrt() * noise
-                else:
-                    noisy_image = data
-                    if config.model.downscale_first:
-                        noisy_image = noisy_image * at.sqrt()
-                if config.model.dynamic_steps:
-                    seq = [torch.arange(0, end, step).to(test_trajectoy_steps.device) for end, step in zip(test_trajectoy_steps, skip)]
-                else:
-                    seq = range(0 , test_trajectoy_steps, skip)
-                
-
-                
-                if config.model.dynamic_steps:            
-        
-                    reconstructed, rec_x0 = my_generalized_steps(data, noisy_image, seq, unet, constants_dict['betas'], config, eta2=config.model.eta2 , eta3=0 , constants_dict=constants_dict ,eraly_stop = False)
-
-                else:
-                    reconstructed, rec_x0 = DA_generalized_steps(data, noisy_image, seq, unet, constants_dict['betas'], config, eta2=config.model.eta2 , eta3=0 , constants_dict=constants_dict ,eraly_stop = False)
-
-                data_reconstructed = reconstructed[-1].to(config.model.device)
-                
-                
+                noisy_image = at.sqrt() * data + (1- at).sqrt() * noise
+            else:
+                noisy_image = data
+                if config.model.downscale_first:
+                    noisy_image = noisy_image * at.sqrt()
+
+            stats = {}
+            # a distilled student covers the same range in fewer steps, see distill_trainer
+            seq = distilled_seq(step_size, skip, getattr(config.model, 'distilled_rounds', 0))
+            if config.model.dynamic_steps:
+                seq = [seq] * data.shape[0]
+                data_reconstructed, rec_x0 = my_generalized_steps(data, noisy_image, seq, unet, constants_dict['betas'], config, eta2=config.model.eta2 , eta3=0 , constants_dict=constants_dict ,eraly_stop = early_stop, final_only=True, stats=stats, noise_provider=noise_provider, sample_ids=sample_ids)
+            else:
+                data_reconstructed, rec_x0 = DA_generalized_steps(data, noisy_image, seq, unet, constants_dict['betas'], config, eta2=config.model.eta2 , eta3=0 , constants_dict=constants_dict ,eraly_stop = early_stop, final_only=True, stats=stats, noise_provider=noise_provider, sample_ids=sample_ids)
+            for item, steps_used in zip(items, stats['steps_used'].tolist()):
+                item['steps_used'] = steps_used
+            return list(data_reconstructed.split(1, dim=0))
+
+        def evaluate_reconstructions(items):
+            # decode and score a batch of reconstructions, already in test set order
+            data_placeholder = torch.cat([item['image'] for item in items], dim=0)
+            data = torch.cat([item['latent'] for item in items], dim=0)
+            data_reconstructed = torch.cat([item['reconstruction'] for item in items], dim=0)
+            l1_latent = color_distance(data_reconstructed, data, config, out_size=config.data.image_size)
+
+            # cascade stage one: images decided on the latent score skip decode and the feature comparison
+            decisions = cascade.decide(latent_score(l1_latent)) if cascade is not None else [None] * len(items)
+            uncertain = [i for i, decision in enumerate(decisions) if decision is None]
+
+            to_decode = [items[i] for i in uncertain if 'decoded' not in items[i]]
+            if to_decode:
                 if config.model.latent_backbone == "VAE":
                     #reconstruct image from latent space
-                    reconstructed = 1 / 0.18215 * data_reconstructed
+                    decoded = 1 / 0.18215 * torch.cat([item['reconstruction'] for item in to_decode], dim=0)
                     if config.model.consistency_decoder:
-                        reconstructed = consistency_decoder(reconstructed)
+                        decoded = consistency_decoder(decoded)
                     else:
-                        reconstructed = vae.decode(reconstructed.to(config.model.device)).sample
+                        with inference_autocast(config):
+                            decoded = vae.decode(decoded.to(config.model.device)).sample.float()
                 else:
                     print(f"error: backbone needs to be VAE")
-                l1_latent = color_distance(data_reconstructed, data, config, out_size=config.data.image_size)
+                for item, image in zip(to_decode, decoded.split(1, dim=0)):
+                    item['decoded'] = image
+                    if recon_cache is not None:
+                        recon_cache.put(item['cache_key'], item['latent'], item['reconstruction'], image, steps_used=item['steps_used'])
+            # decided images are not decoded, their input stands in for the visualisation
+            reconstructed = torch.cat([(item['image'] if decision is not None else item['decoded']).to(config.model.device) for item, decision in zip(items, decisions)], dim=0)
+            if len(uncertain) == len(items):
                 cos_dist = feature_distance_new(reconstructed, data_placeholder, feature_extractor,config)
-                
-                anomaly_map_latent = recon_heat_map(data_reconstructed,data,config)
                 anomaly_map_feature = feature_heat_map(reconstructed,data_placeholder,feature_extractor,config)
-                    
+            else:
+                # NaN marks maps that were never computed, filled once all images are scored
+                cos_dist = torch.full_like(l1_latent, float('nan'))
+                anomaly_map_feature = torch.zeros_like(l1_latent)
+                if uncertain:
+                    index = torch.tensor(uncertain)
+                    cos_dist[index.to(cos_dist.device)] = feature_distance_new(reconstructed[index.to(reconstructed.device)], data_placeholder[index], feature_extractor,config)
+                    anomaly_map_feature[index.to(cos_dist.device)] = feature_heat_map(reconstructed[index.to(reconstructed.device)], data_placeholder[index], feature_extractor,config)
+            
+            anomaly_map_latent = recon_heat_map(data_reconstructed,data,config)
                 
-                l1_latent_list.append(l1_latent)
-                cos_dist_list.append(cos_dist)
+            filename_list.append(tuple(item['filename'] for item in items))
+            forward_list_orig.append(data_placeholder)
+            forward_list.append(data_placeholder)
+
+            l1_latent_list.append(l1_latent)
+            cos_dist_list.append(cos_dist)
+            
+            anomaly_map_latent_list.append(anomaly_map_latent)
+            anomaly_map_feature_list.append(anomaly_map_feature)
                 
-                anomaly_map_latent_list.append(anomaly_map_latent)
-                anomaly_map_feature_list.append(anomaly_map_feature)
+            GT_list.append(torch.cat([item['target'] for item in items], dim=0))
+            reconstructed_list.append(reconstructed)
+
+            for item, decision in zip(items, decisions):
+                labels_list.append(0 if item['label'] == 'good' else 1)
+                steps_used_list.append(item['steps_used'])
+                cascade_list.append(decision)
+
+        def calibrate_cascade():
+            """
+            LatentCascade from the train latent scores, reused from disk when the checkpoint,
+            sampler and step size settings match; returns (cascade, seconds spent scoring)
+            """
+            params = dict(sampler_params(config),
+                          test_trajectoy_steps=config.model.test_trajectoy_steps, skip=config.model.skip,
+                          dynamic_num_steps=getattr(config.model, 'dynamic_num_steps', 10), knn_k=config.model.knn_k,
+                          KNN_metric=getattr(config.model, 'KNN_metric', 'euclidean'), DA_epochs=config.model.DA_epochs,
+                          knn_compression=getattr(config.model, 'knn_compression', 'none'),
+                          knn_projection_dim=getattr(config.model, 'knn_projection_dim', None),
+                          knn_pq_subspaces=getattr(config.model, 'knn_pq_subspaces', None),
+                          knn_pq_bits=getattr(config.model, 'knn_pq_bits', None))
+            path = calibration_path(config, model_hash(unet), params)
+            scores = load_calibration(path)
+            seconds = 0.0
+            if scores is None:
+                calibration_start = time.time()
+                scores = train_latent_scores()
+                seconds = time.time() - calibration_start
+                save_calibration(path, scores)
+                print('Cascade calibration time is ', str(timedelta(seconds=seconds)))
+            else:
+                print(f"cascade calibration loaded from {path}")
+            return LatentCascade.calibrate(scores, config), seconds
+
+        def train_latent_scores():
+            # latent scores of the good train images, chosen step sizes and reverse process as for test images
+            train_dataset = MVTecDataset(root=config.data.data_dir, category=config.data.category, config=config, is_train=True)
+            calibration_loader = torch.utils.data.DataLoader(train_dataset, batch_size=config.data.batch_size, shuffle=False,
+                                                             num_workers=config.model.num_workers, drop_last=False)
+            scheduler = StepSizeBucketScheduler(reconstruct_bucket, batch_size=config.data.batch_size)
+            scores = []
+
+            def score(done):
+                for item in done:
+                    l1 = color_distance(item['reconstruction'], item['latent'], config, out_size=config.data.image_size)
+                    scores.append(latent_score(l1).item())
+
+            # ids after the test set so per-sample noise streams do not repeat test noise
+            index = len(test_dataset)
+            for batch in calibration_loader:
+                data = batch[0]
+                step_size, skip = select_steps(data)
+                items = [{'id': index + i, 'image': data[i:i+1], 'step_size': int(step_size[i]), 'skip': int(skip[i])} for i in range(data.shape[0])]
+                encode_items(items)
+                for item in items:
+                    score(scheduler.add(item['id'], item, item['step_size'], item['skip']))
+                index += len(items)
+            score(scheduler.flush())
+            return scores
+
+        recon_cache = None
+        if getattr(config.model, 'recon_cache', False):
+            # repeat evaluations with the same images, checkpoint and sampler settings skip diffusion
+            recon_cache = ReconstructionCache(config.model.recon_cache_dir, config.model.recon_cache_max_gb * 1024 ** 3, model_id=model_hash(unet))
+            cache_params = sampler_params(config)
+
+        bucket_scheduler = StepSizeBucketScheduler(reconstruct_bucket, batch_size=config.data.batch_size)
+        pending = []
+        sample_index = 0
+
+        cascade = None
+        calibration_seconds = None
+        with torch.no_grad():
+            if getattr(config.model, 'cascade', False):
+                # reported separately from the inference time below
+                cascade, calibration_seconds = calibrate_cascade()
+            start = time.time()
+            try:
+                for step, (data, targets, labels, filename) in enumerate(testloader):
+                
+                
+                    data_placeholder = data
+                
+                    step_size, skip = select_steps(data)
+                    if config.model.dynamic_steps:
+                        step_list.extend(step_size)
                     
-                GT_list.append(targets)
-                reconstructed_list.append(reconstructed)
-
-                for label in labels:
-                    labels_list.append(0 if label == 'good' else 1)
+                    items = []
+                    for i in range(data.shape[0]):
+                        item = {
+                            'id': sample_index + i,
+                            'image': data_placeholder[i:i+1],
+                            'target': targets[i:i+1],
+                            'label': labels[i],
+                            'filename': filename[i],
+                            'step_size': int(step_size[i]),
+                            'skip': int(skip[i]),
+                        }
+                        if recon_cache is not None:
+                            item['cache_key'] = recon_cache.key(item['image'], dict(cache_params, step_size=item['step_size'], skip=item['skip']))
+                            cached = recon_cache.get(item['cache_key'])
+                            if cached is not None:
+                                item['latent'] = cached['latent'].to(config.model.device)
+                                item['reconstruction'] = cached['reconstruction'].to(config.model.device)
+                                item['decoded'] = cached['image']
+                                # reverse steps of the run that produced the entry, None for entries without them
+                                item['steps_used'] = cached['steps_used']
+                        items.append(item)
+
+                    # only cache misses are encoded and go through the reverse process
+                    encode_items([item for item in items if 'reconstruction' not in item])
+                
+                    # group images by (step size, skip); finished groups come back in test set order
+                    for item in items:
+                        if 'reconstruction' in item:
+                            pending.extend(bucket_scheduler.complete(item['id'], item))
+                        else:
+                            pending.extend(bucket_scheduler.add(item['id'], item, item['step_size'], item['skip']))
+                    sample_index += len(items)
+
+                    while len(pending) >= config.data.batch_size:
+                        evaluate_reconstructions(pending[:config.data.batch_size])
+                        pending = pending[config.data.batch_size:]
+
+                pending.extend(bucket_scheduler.flush())
+                while pending:
+                    evaluate_reconstructions(pending[:config.data.batch_size])
+                    pending = pending[config.data.batch_size:]
+            finally:
+                if recon_cache is not None:
+                    # also on an interrupted run, or the entries written so far never count toward max_bytes
+                    recon_cache.save()
                 
                 
             
 
+    if cascade is not None:
+        # decided images carry no feature evidence: the smallest computed feature distance
+        computed = torch.cat([c[~torch.isnan(c)] for c in cos_dist_list])
+        fill = computed.min().item() if computed.numel() else 0.0
+        cos_dist_list = [torch.nan_to_num(c, nan=fill) for c in cos_dist_list]
+
     l1_latent_normalized_list = scale_values_between_zero_and_one(l1_latent_list)
     cos_dist_normalized_list = scale_values_between_zero_and_one(cos_dist_list)
 
@@ -358,6 +632,12 @@ def validate(unet, constants_dict, config):
     predictions_normalized = []
     for heatmap in concat_heatmap:
         predictions_normalized.append(torch.max(heatmap).item() )
+    # stage one decisions are final, at the bottom / top of the normalized score range
+    for i, decision in enumerate(cascade_list):
+        if decision == GOOD:
+            predictions_normalized[i] = 0.0
+        elif decision == ANOMALOUS:
+            predictions_normalized[i] = 1.0
         
 
     threshold = metric(labels_list, predictions_normalized, heatmap_latent_list, GT_list, config)
@@ -365,6 +645,14 @@ def validate(unet, constants_dict, config):
     
     end = time.time()
     print('Inference time is ', str(timedelta(seconds=end - start)))
+    known_steps = [steps_used for steps_used in steps_used_list if steps_used is not None]
+    if known_steps:
+        print(f'Reverse steps per image: mean {np.mean(known_steps):.2f}, min {np.min(known_steps)}, max {np.max(known_steps)}')
+        if getattr(config.model, 'early_stop', False):
+            for name, steps_used in zip([item for tup in filename_list for item in tup], steps_used_list):
+                if steps_used is not None:
+                    print(f'  {name}: {steps_used} steps')
+    cascade_rates = cascade.report(calibration_seconds) if cascade is not None else None
     print('threshold: ', threshold)
 
     
@@ -382,4 +670,13 @@ def validate(unet, constants_dict, config):
     GT_list = torch.cat(GT_list, dim=0)
     
     pred_mask = (concat_heatmap> threshold).float()
-    visualize(forward_list, reconstructed_list, GT_list, pred_mask, concat_heatmap, config.data.category, config, forward_list_orig, step_list,filename_list, anomaly_map_recon_list, anomaly_map_latent_list, anomaly_map_feature_list)
\ No newline at end of file
+    visualize(forward_list, reconstructed_list, GT_list, pred_mask, concat_heatmap, config.data.category, config, forward_list_orig, step_list,filename_list, anomaly_map_recon_list, anomaly_map_latent_list, anomaly_map_feature_list)
+
+    return {
+        'threshold': threshold,
+        'labels': labels_list,
+        'predictions': predictions_normalized,
+        'latent_l1': torch.cat(l1_latent_list, dim=0).mean().item(),
+        'steps_used': steps_used_list,
+        'cascade': cascade_rates,
+    }
\ No newline at end of file
@@ -0,0 +1,152 @@
+import copy
+import time
+from datetime import timedelta
+
+import torch
+
+from anomaly_map import color_distance, feature_distance_new, heatmap_latent, scale_values_between_zero_and_one
+from chunked_vae import bounded_vae
+from dataset import MVTecDataset
+from feature_extractor import adapted_feature_extractor
+from metrics import metric
+from registry import get_vae
+from sample import distilled_seq, validate_steps
+from test import fit_knn, knn_steps
+from utilities import blend_window, get_schedule, inference_autocast, tile_positions, to_channels_last
+
+
+class TileStitcher:
+    """
+    Accumulates weighted per-tile maps of one image; finished when all of its
+    tiles were added
+    """
+    def __init__(self, height, width, num_tiles, device):
+        self.remaining = num_tiles
+        self.weight = torch.zeros(1, 1, height, width, device=device)
+        self.maps = {}
+
+    def add(self, y, x, window, **maps):
+        tile = window.shape[-1]
+        self.weight[..., y:y + tile, x:x + tile] += window
+        for name, tile_map in maps.items():
+            if name not in self.maps:
+                self.maps[name] = torch.zeros_like(self.weight)
+            self.maps[name][..., y:y + tile, x:x + tile] += window * tile_map
+        self.remaining -= 1
+
+    def result(self, name):
+        return self.maps[name] / self.weight
+
+
+def tiled_validate(unet, constants_dict, config):
+    """
+    validate for large images: test images are loaded at data.tiled_image_size
+    and split into overlapping data.image_size tiles. Tiles from consecutive
+    images are batched together (data.tile_batch_size) through VAE encode, the
+    DDAD reverse process, decode and the feature distance. With
+    model.dynamic_steps every tile gets its own step size from the KNN, as an
+    image does in validate, and tiles are batched per step size. The per-tile
+    latent and feature maps are stitched with linear blending, and each image
+    is scored by the max of its stitched heat map.
+    """
+    tile = config.data.image_size
+    overlap = config.data.tile_overlap
+    tile_batch_size = config.data.tile_batch_size
+    device = config.model.device
+
+    tiled_config = copy.deepcopy(config)
+    tiled_config.data.image_size = config.data.tiled_image_size
+    test_dataset = MVTecDataset(root=config.data.data_dir, category=config.data.category, config=tiled_config, is_train=False)
+    testloader = torch.utils.data.DataLoader(test_dataset, batch_size=config.data.batch_size, shuffle=False,
+                                             num_workers=config.model.num_workers, drop_last=False)
+
+    # train images are loaded at data.image_size, the tile size
+    train_dataset = MVTecDataset(root=config.data.data_dir, category=config.data.category, config=config, is_train=True)
+    trainloader = torch.utils.data.DataLoader(train_dataset, batch_size=config.data.DA_batch_size, shuffle=True,
+                                              num_workers=config.model.num_workers, drop_last=False)
+
+    vae = bounded_vae(get_vae(config), config)
+    # the same domain adapted feature extractor as validate
+    feature_extractor = adapted_feature_extractor(unet, vae, config, constants_dict, trainloader)
+
+    knn = None
+    if config.model.dynamic_steps:
+        # train images have the tile size, so tiles are placed in the same histogram as validate's images
+        knn = fit_knn(feature_extractor, trainloader, config)
+
+    schedule = get_schedule(constants_dict, config)
+    window = blend_window(tile, overlap, device)
+
+    def select_steps(tiles):
+        # (step_size, skip) per tile
+        if knn is None:
+            return [(int(config.model.test_trajectoy_steps), int(config.model.skip))] * len(tiles)
+        step_size, skip = knn_steps(knn, feature_extractor, torch.cat([image for _, _, _, image in tiles], dim=0), config)
+        return list(zip(step_size.astype(int).tolist(), skip.astype(int).tolist()))
+
+    def run_tiles(tiles, step_size, skip):
+        # one batch of tiles sharing (step_size, skip), possibly from several images
+        images = to_channels_last(torch.cat([image for _, _, _, image in tiles], dim=0).to(device), config)
+        with inference_autocast(config):
+            latent = vae.encode(images).latent_dist.sample().float() * 0.18215
+        at = schedule.alpha_bar(step_size)
+        if config.model.noise_sampling:
+            noisy = at.sqrt() * latent + (1 - at).sqrt() * torch.randn_like(latent)
+        else:
+            noisy = latent * at.sqrt() if config.model.downscale_first else latent
+        # same sampler as reconstruct_bucket in validate
+        seq = distilled_seq(step_size, skip, getattr(config.model, 'distilled_rounds', 0))
+        reconstruction, _ = validate_steps(latent, noisy, seq, unet, constants_dict['betas'], config, eta2=config.model.eta2, eta3=0, constants_dict=constants_dict, final_only=True)
+        with inference_autocast(config):
+            decoded = vae.decode(1 / 0.18215 * reconstruction).sample.float()
+        l1 = color_distance(reconstruction, latent, config, out_size=tile)
+        feature = feature_distance_new(decoded, images, feature_extractor, config)
+        for (index, y, x, _), l1_map, feature_map in zip(tiles, l1.split(1), feature.split(1)):
+            stitchers[index].add(y, x, window, l1=l1_map, feature=feature_map)
+
+    stitchers = {}
+    buckets = {}
+    labels_list, GT_list, l1_list, feature_list = [], [], [], []
+    image_index = 0
+
+    def collect_finished():
+        # buckets finish out of order, images are collected in test set order
+        while stitchers and stitchers[min(stitchers)].remaining == 0:
+            stitcher = stitchers.pop(min(stitchers))
+            l1_list.append(stitcher.result('l1'))
+            feature_list.append(stitcher.result('feature'))
+
+    with torch.no_grad():
+        start = time.time()
+        for data, targets, labels, filename in testloader:
+            for i in range(data.shape[0]):
+                height, width = data.shape[-2:]
+                ys, xs = tile_positions(height, tile, overlap), tile_positions(width, tile, overlap)
+                stitchers[image_index] = TileStitcher(height, width, len(ys) * len(xs), device)
+                tiles = [(image_index, y, x, data[i:i + 1, :, y:y + tile, x:x + tile]) for y in ys for x in xs]
+                for tile_item, key in zip(tiles, select_steps(tiles)):
+                    bucket = buckets.setdefault(key, [])
+                    bucket.append(tile_item)
+                    if len(bucket) >= tile_batch_size:
+                        run_tiles(buckets.pop(key), *key)
+                labels_list.append(0 if labels[i] == 'good' else 1)
+                GT_list.append(targets[i:i + 1])
+                image_index += 1
+            collect_finished()
+        for key in list(buckets):
+            run_tiles(buckets.pop(key), *key)
+        collect_finished()
+
+    # same normalisation and fusion as validate, on the stitched full resolution maps
+    heatmaps = heatmap_latent(scale_values_between_zero_and_one(l1_list), scale_values_between_zero_and_one(feature_list), config)
+    predictions = [torch.max(heatmap).item() for heatmap in heatmaps]
+    heatmaps = [heatmap.cpu() for heatmap in heatmaps]
+    threshold = metric(labels_list, predictions, heatmaps, GT_list, tiled_config)
+
+    print('Tiled inference time is ', str(timedelta(seconds=time.time() - start)))
+    print('threshold: ', threshold)
+    return {
+        'threshold': threshold,
+        'labels': labels_list,
+        'predictions': predictions,
+    }
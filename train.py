@@ -1,6 +1,9 @@
 import torch
 import os
+import copy
+import random
 import torch.nn as nn
+import torch.nn.functional as F
 from forward_process import *
 from dataset import *
 from diffusers import AutoencoderKL
@@ -13,6 +16,9 @@ from test import *
 from loss import *
 from optimizer import *
 from sample import *
+from registry import TRAIN_VAE, get_vae, release, vae_key
+from chunked_vae import bounded_vae
+from latent_cache import CachedLatentDistribution, build_latent_cache
 
 def trainer(model, constants_dict, ema_helper, config):
     optimizer = build_optimizer(model, config)
@@ -56,15 +62,36 @@ def trainer(model, constants_dict, ema_helper, config):
     elif config.data.name == 'cifar10':
         trainloader, testloader = load_data(dataset_name='cifar10')
 
+    # 預先編碼的 latent 分佈 (config.model.latent_cache): 訓練時不載入影像也不需要 VAE
+    latent_cache = config.model.latent and getattr(config.model, 'latent_cache', False)
+    if latent_cache:
+        trainloader = torch.utils.data.DataLoader(
+            build_latent_cache(config, train_dataset),
+            batch_size=config.data.batch_size,
+            shuffle=True,
+            num_workers=config.model.num_workers,
+            drop_last=True,
+        )
+
     # 設定 VAE 模型
-    if config.model.latent:
+    if config.model.latent and not latent_cache:
         if config.model.latent_backbone == "VAE":
-            vae = AutoencoderKL.from_pretrained("stabilityai/stable-diffusion-2-1", subfolder="vae")
-            vae.to(config.model.device)
-            vae.eval()
+            vae = bounded_vae(get_vae(config, TRAIN_VAE), config)
         else:
             raise ValueError("error: backbone needs to be VAE")
 
+    # 逐樣本噪聲流 (config.model.per_sample_noise), 樣本編號由 epoch 與資料集索引組成:
+    # 與打亂順序無關, 但同一張影像每個 epoch 抽到不同的 latent 與噪聲 (validate 只用索引, 以便重現)
+    noise_provider = NoiseProvider.from_config(config)
+    if noise_provider is not None:
+        trainloader = torch.utils.data.DataLoader(
+            IndexedDataset(trainloader.dataset),
+            batch_size=config.data.batch_size,
+            shuffle=True,
+            num_workers=config.model.num_workers,
+            drop_last=True,
+        )
+
     # 訓練迴圈
     best_loss = float('inf')
     for epoch in range(start_epoch, config.model.epochs):
@@ -73,16 +100,26 @@ def trainer(model, constants_dict, ema_helper, config):
         
         for step, batch in enumerate(trainloader):
             t = torch.randint(0, config.model.trajectory_steps, (batch[0].shape[0],), device=config.model.device).long()
+            sample_ids = [epoch * len(trainloader.dataset) + i for i in batch[-1].tolist()] if noise_provider is not None else None
             optimizer.zero_grad()
             
             if config.model.latent:
                 if config.model.latent_backbone == "VAE":     
-                    features = vae.encode(batch[0].to(config.model.device)).latent_dist.sample() * 0.18215
-                    loss = get_loss(model, constants_dict, features, t, config)
+                    if latent_cache:
+                        latent_dist = CachedLatentDistribution(batch[0].to(config.model.device), batch[1].to(config.model.device))
+                    else:
+                        # VAE 凍結, 不保留 encode 的中間激活
+                        with torch.no_grad():
+                            latent_dist = vae.encode(batch[0].to(config.model.device)).latent_dist
+                    if noise_provider is not None:
+                        features = noise_provider.sample_latent(latent_dist, sample_ids) * 0.18215
+                    else:
+                        features = latent_dist.sample() * 0.18215
+                    loss = get_loss(model, constants_dict, features, t, config, noise_provider, sample_ids)
                 else:
                     raise ValueError("error: backbone needs to be VAE")
             else:
-                loss = get_loss(model, constants_dict, batch[0], t, config) 
+                loss = get_loss(model, constants_dict, batch[0], t, config, noise_provider, sample_ids) 
 
             loss.backward()
             optimizer.step()
@@ -121,6 +158,9 @@ def trainer(model, constants_dict, ema_helper, config):
                 "optimizer_state_dict": optimizer.state_dict()
             }, save_path)
                 
+    if config.model.latent and not latent_cache:
+        release(vae_key(TRAIN_VAE), config)
+
     # 最後一個 epoch 存檔
     if config.model.save_model:
         final_save_path = os.path.join(
@@ -134,3 +174,93 @@ def trainer(model, constants_dict, ema_helper, config):
         }, final_save_path)
 
     return model
+
+
+def distilled_checkpoint_path(config, rounds):
+    return os.path.join(
+        os.getcwd(), config.model.checkpoint_dir, config.data.category,
+        f"{config.model.latent_size}_{config.model.unet_channel}_{config.model.n_head}_{config.model.head_channel}_diffusers_unet_{config.model.checkpoint_epochs}_distilled{rounds}"
+    )
+
+def distill_trainer(teacher, constants_dict, config):
+    """
+    Progressive step distillation: 每一輪由 teacher 複製出 student, 讓 student 以一步重現 teacher
+    兩步的 DDAD 條件反向結果, 步數減半; config.model.distill_rounds 輪後 (例如 10 -> 5 -> 3 -> 2 步)
+    以 config.model.distilled_rounds 在 validate 中直接取代原本的取樣迴圈
+    蒸餾使用確定性的 DDIM 更新 (eta = 0)
+    """
+    config = copy.deepcopy(config)
+    config.model.eta = 0
+    config.model.solver = 'ddim'
+    config.model.distilled_rounds = 0
+
+    train_dataset = MVTecDataset(
+        root=config.data.data_dir,
+        category=config.data.category,
+        config=config,
+        is_train=True,
+    )
+    trainloader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_size=config.data.batch_size,
+        shuffle=True,
+        num_workers=config.model.num_workers,
+        drop_last=True,
+    )
+    # 與 validate 相同的 VAE, student 學習的是評估時的重建
+    vae = bounded_vae(get_vae(config), config)
+
+    schedule = get_schedule(constants_dict, config)
+    schedules = reverse_schedules(config)
+    model_save_dir = os.path.join(os.getcwd(), config.model.checkpoint_dir, config.data.category)
+    os.makedirs(model_save_dir, exist_ok=True)
+
+    teacher.eval()
+    for rounds in range(config.model.distill_rounds):
+        student = copy.deepcopy(teacher)
+        student.train()
+        optimizer = build_optimizer(student, config)
+
+        for epoch in range(config.model.distill_epochs):
+            for step, batch in enumerate(trainloader):
+                step_size, skip = random.choice(schedules)
+                teacher_seq = distilled_seq(step_size, skip, rounds)
+                student_seq = distilled_seq(step_size, skip, rounds + 1)
+
+                with torch.no_grad():
+                    y = vae.encode(batch[0].to(config.model.device)).latent_dist.sample() * 0.18215
+                    at = schedule.alpha_bar(step_size)
+                    if config.model.noise_sampling:
+                        x = at.sqrt() * y + (1 - at).sqrt() * torch.randn_like(y)
+                    else:
+                        x = y * at.sqrt() if config.model.downscale_first else y
+
+                    # teacher 軌跡: 進入每個時間步前的狀態, -1 為最後的重建; 與 validate 使用同一個 sampler
+                    states = {teacher_seq[-1]: x}
+                    next_steps = list(reversed([-1] + teacher_seq[:-1]))
+                    def record(index, xt_next, x0_t):
+                        states[next_steps[index]] = xt_next
+                    validate_steps(y, x, teacher_seq, teacher, constants_dict['betas'], config, eta2=config.model.eta2, eta3=0, constants_dict=constants_dict, final_only=True, callback=record)
+
+                # student 每一步從 teacher 的狀態出發, 目標是 teacher 兩步後的狀態
+                optimizer.zero_grad()
+                loss = 0
+                for i, t in enumerate(student_seq):
+                    t_next = student_seq[i - 1] if i > 0 else -1
+                    xt = states[t]
+                    et = student(xt, torch.full((xt.shape[0],), float(t), device=xt.device))
+                    stochastic = t != student_seq[-1] or first_step_stochastic(config)
+                    xt_next, _ = ddad_update(xt, et, y, schedule.alpha_bar(t), schedule.alpha_bar(t_next), config.model.eta2, 0, stochastic=stochastic)
+                    loss = loss + F.mse_loss(xt_next, states[t_next])
+                loss.backward()
+                optimizer.step()
+
+                if step % 10 == 0:
+                    print(f"Distill round {rounds + 1} | Epoch {epoch} | Step {step} | Loss: {loss.item():.6f}")
+
+        student.eval()
+        torch.save(student.state_dict(), distilled_checkpoint_path(config, rounds + 1))
+        print(f"round {rounds + 1}: {len(distilled_seq(*schedules[-1], rounds + 1))} reverse steps, saved to {distilled_checkpoint_path(config, rounds + 1)}")
+        teacher = student
+
+    return teacher
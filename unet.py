@@ -5,6 +5,7 @@ from abc import abstractmethod
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import nn
 
 
@@ -24,11 +25,19 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
     """
     A sequential module that passes timestep embeddings to the children that
     support it as an extra input.
+    With use_checkpoint set, ResBlock and AttentionBlock children are run under
+    activation checkpointing while gradients are required: their activations
+    are recomputed in the backward pass instead of being stored.
     """
 
+    use_checkpoint = False
+
     def forward(self, x, emb):
+        checkpoint = self.use_checkpoint and torch.is_grad_enabled()
         for layer in self:
-            if isinstance(layer, TimestepBlock):
+            if checkpoint and isinstance(layer, (ResBlock, AttentionBlock)):
+                x = torch.utils.checkpoint.checkpoint(layer, x, emb, use_reentrant=False)
+            elif isinstance(layer, TimestepBlock):
                 x = layer(x, emb)
             else:
                 x = layer(x)
@@ -117,12 +126,41 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(nn.Conv1d(in_channels, in_channels, 1))
 
     def forward(self, x, time=None):
+        x_in = x
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
         qkv = self.to_qkv(self.norm(x))
         h = self.attention(qkv)
         h = self.proj_out(h)
-        return (x + h).reshape(b, c, *spatial)
+        out = (x + h).reshape(b, c, *spatial)
+        if len(spatial) == 2 and x_in.is_contiguous(memory_format=torch.channels_last):
+            # keep NHWC inputs in NHWC for the following convolutions
+            out = out.contiguous(memory_format=torch.channels_last)
+        return out
+
+    @torch.no_grad()
+    def prune_heads(self, keep):
+        """
+        Keep only the attention heads with indices `keep`; the block's input and
+        output width is unchanged. Used by structured pruning, see pruning.py.
+        """
+        keep = torch.as_tensor(keep, dtype=torch.long, device=self.to_qkv.weight.device)
+        ch = self.in_channels // self.num_heads
+        # qkv rows are head-major [q_h, k_h, v_h], the attention output is head-major [a_h]
+        qkv_rows = (keep[:, None] * 3 * ch + torch.arange(3 * ch, device=keep.device)).flatten()
+        out_cols = (keep[:, None] * ch + torch.arange(ch, device=keep.device)).flatten()
+
+        to_qkv = nn.Conv1d(self.in_channels, len(qkv_rows), 1).to(self.to_qkv.weight)
+        to_qkv.weight.copy_(self.to_qkv.weight[qkv_rows])
+        to_qkv.bias.copy_(self.to_qkv.bias[qkv_rows])
+        proj_out = nn.Conv1d(len(out_cols), self.in_channels, 1).to(self.proj_out.weight)
+        proj_out.weight.copy_(self.proj_out.weight[:, out_cols])
+        proj_out.bias.copy_(self.proj_out.bias)
+
+        self.to_qkv, self.proj_out = to_qkv, proj_out
+        self.num_heads = len(keep)
+        self.attention.n_heads = len(keep)
+        return self
 
 
 class QKVAttention(nn.Module):
@@ -130,13 +168,18 @@ class QKVAttention(nn.Module):
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, chunk_size=256):
         super().__init__()
         self.n_heads = n_heads
+        # query chunk length of the memory-efficient fallback
+        self.chunk_size = chunk_size
 
     def forward(self, qkv, time=None):
         """
         Apply QKV attention.
+        Uses the fused scaled_dot_product_attention kernel when available and a
+        chunked implementation otherwise, so the full T x T matrix is never
+        materialized for all queries at once.
         :param qkv: an [N x (H * 3 * C) x T] tensor of Qs, Ks, and Vs.
         :return: an [N x (H * C) x T] tensor after attention.
         """
@@ -144,14 +187,36 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-                "bct,bcs->bts", q * scale, k * scale
-                )  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v)
+        if hasattr(F, "scaled_dot_product_attention"):
+            # default scale is 1 / sqrt(ch), same as scaling q and k by ch ** -0.25 each;
+            # run in float under convert_to_dtype so the softmax stays in float32
+            a = F.scaled_dot_product_attention(
+                    q.transpose(1, 2).float(), k.transpose(1, 2).float(), v.transpose(1, 2).float()
+                    ).transpose(1, 2).type(qkv.dtype)
+        else:
+            a = self.chunked_attention(q, k, v)
         return a.reshape(bs, -1, length)
 
+    def chunked_attention(self, q, k, v):
+        """
+        Reference attention computed over query chunks; numerically the same as
+        the unchunked einsum/softmax formulation.
+        :param q, k, v: [N x C x T] tensors.
+        :return: an [N x C x T] tensor.
+        """
+        ch = q.shape[1]
+        scale = 1 / math.sqrt(math.sqrt(ch))
+        k = k * scale
+        out = []
+        for start in range(0, q.shape[-1], self.chunk_size):
+            q_chunk = q[..., start:start + self.chunk_size]
+            weight = torch.einsum(
+                    "bct,bcs->bts", q_chunk * scale, k
+                    )  # More stable with f16 than dividing afterwards
+            weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+            out.append(torch.einsum("bts,bcs->bct", weight, v))
+        return torch.cat(out, dim=-1)
+
 
 class ResBlock(TimestepBlock):
     def __init__(
@@ -199,6 +264,9 @@ class ResBlock(TimestepBlock):
         else:
             self.skip_connection = nn.Conv2d(in_channels, out_channels, 1)
 
+        # projected time embedding looked up by UNetModel's timestep cache, see UNetModel.cache_timesteps
+        self.cached_emb_out = None
+
     def forward(self, x, time_embed):
         if self.updown:
             in_rest, in_conv = self.in_layers[:-1], self.in_layers[-1]
@@ -208,7 +276,10 @@ class ResBlock(TimestepBlock):
             h = in_conv(h)
         else:
             h = self.in_layers(x)
-        emb_out = self.embed_layers(time_embed).type(h.dtype)
+        if self.cached_emb_out is not None:
+            emb_out = self.cached_emb_out.type(h.dtype)
+        else:
+            emb_out = self.embed_layers(time_embed).type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
 
@@ -216,6 +287,41 @@ class ResBlock(TimestepBlock):
         h = self.out_layers(h)
         return self.skip_connection(x) + h
 
+    @property
+    def hidden_channels(self):
+        return self.in_layers[-1].out_channels
+
+    @torch.no_grad()
+    def prune_channels(self, keep):
+        """
+        Keep only the hidden channels `keep` between in_layers and out_layers;
+        the block's input and output width is unchanged. GroupNorm32 needs a
+        multiple of 32 channels. Used by structured pruning, see pruning.py.
+        """
+        keep = torch.as_tensor(keep, dtype=torch.long, device=self.in_layers[-1].weight.device)
+        assert len(keep) % 32 == 0, f"hidden channels must be a multiple of 32, got {len(keep)}"
+        in_conv, linear = self.in_layers[-1], self.embed_layers[1]
+        norm, out_conv = self.out_layers[0], self.out_layers[-1]
+
+        new_in_conv = nn.Conv2d(in_conv.in_channels, len(keep), 3, padding=1).to(in_conv.weight)
+        new_in_conv.weight.copy_(in_conv.weight[keep])
+        new_in_conv.bias.copy_(in_conv.bias[keep])
+        new_linear = nn.Linear(linear.in_features, len(keep)).to(linear.weight)
+        new_linear.weight.copy_(linear.weight[keep])
+        new_linear.bias.copy_(linear.bias[keep])
+        new_norm = GroupNorm32(32, len(keep)).to(norm.weight)
+        new_norm.weight.copy_(norm.weight[keep])
+        new_norm.bias.copy_(norm.bias[keep])
+        new_out_conv = nn.Conv2d(len(keep), out_conv.out_channels, 3, padding=1).to(out_conv.weight)
+        new_out_conv.weight.copy_(out_conv.weight[:, keep])
+        new_out_conv.bias.copy_(out_conv.bias)
+
+        self.in_layers[-1] = new_in_conv
+        self.embed_layers[1] = new_linear
+        self.out_layers[0] = new_norm
+        self.out_layers[-1] = new_out_conv
+        return self
+
 
 class UNetModel(nn.Module):
     # UNet model
@@ -387,10 +493,125 @@ class UNetModel(nn.Module):
                 zero_module(nn.Conv2d(base_channels * channel_mults[0], self.out_channels, 3, padding=1))
                 )
 
-    def forward(self, x, time):
+        self._time_cache = None
 
-        time_embed = self.time_embedding(time)
+    def convert_to_dtype(self, dtype):
+        """
+        Run the down, middle and up blocks in a reduced precision `dtype`.
+        Only convolution weights are converted: GroupNorm32, the time embedding
+        MLP and the output head stay in float32 and the attention softmax is
+        computed in float.
+        """
+        def convert(module):
+            if isinstance(module, (nn.Conv1d, nn.Conv2d, nn.Conv3d)):
+                module.weight.data = module.weight.data.to(dtype)
+                if module.bias is not None:
+                    module.bias.data = module.bias.data.to(dtype)
+
+        self.down.apply(convert)
+        self.middle.apply(convert)
+        self.up.apply(convert)
+        self.dtype = dtype
+        return self
+
+    def set_gradient_checkpointing(self, enabled=True):
+        """
+        Trade compute for memory in training: every ResBlock and AttentionBlock
+        recomputes its activations during backward, see TimestepEmbedSequential.
+        """
+        for module in self.modules():
+            if isinstance(module, TimestepEmbedSequential):
+                module.use_checkpoint = enabled
+        return self
+
+    def _res_blocks(self):
+        return [module for module in self.modules() if isinstance(module, ResBlock)]
+
+    def _time_weights_version(self):
+        # changes whenever a time embedding / projection weight is updated in place
+        # (optimizer step, load_state_dict) or replaced (.to, convert_to_dtype)
+        params = list(self.time_embedding.parameters())
+        for block in self._res_blocks():
+            params.extend(block.embed_layers.parameters())
+        return tuple((p.data_ptr(), p._version, p.dtype) for p in params)
+
+    def cache_timesteps(self, timesteps):
+        """
+        Precompute the time embedding and every ResBlock's projected embedding
+        for the integer `timesteps` used at inference. Subsequent calls to
+        forward(x, time, timesteps=...) look them up instead of recomputing
+        them. The cache is rebuilt when the time embedding weights change.
+        """
+        timesteps = set(int(t) for t in timesteps)
+        version = self._time_weights_version()
+        if self._time_cache is not None and self._time_cache['version'] == version:
+            if timesteps.issubset(self._time_cache['index']):
+                return self
+            timesteps |= set(self._time_cache['index'])
+        timesteps = sorted(timesteps)
+
+        blocks = self._res_blocks()
+        device = next(self.parameters()).device
+        with torch.no_grad():
+            time_embed = self.time_embedding(torch.tensor(timesteps, device=device, dtype=torch.float32))
+            emb_outs = [block.embed_layers(time_embed) for block in blocks]
+        self._time_cache = {
+            'index': {t: i for i, t in enumerate(timesteps)},
+            'time_embed': time_embed,
+            'emb_outs': emb_outs,
+            'blocks': blocks,
+            'version': version,
+            }
+        return self
+
+    def clear_time_cache(self):
+        self._time_cache = None
+        return self
+
+    def _lookup_time_cache(self, timesteps):
+        """
+        Return (time_embed, emb_outs, blocks) for `timesteps`, or None when the
+        cache cannot be used (training, gradients enabled, stale weights or an
+        uncached timestep)
+        """
+        cache = self._time_cache
+        if cache is None or self.training or torch.is_grad_enabled():
+            return None
+        if cache['version'] != self._time_weights_version():
+            self._time_cache = None
+            return None
+        try:
+            rows = [cache['index'][int(t)] for t in timesteps]
+        except KeyError:
+            return None
+        if all(row == rows[0] for row in rows):
+            # same timestep for the whole batch: a broadcastable [1, C] slice, no gather
+            select = lambda table: table[rows[0]:rows[0] + 1]
+        else:
+            rows = torch.tensor(rows, device=cache['time_embed'].device)
+            select = lambda table: table.index_select(0, rows)
+        return select(cache['time_embed']), [select(e) for e in cache['emb_outs']], cache['blocks']
 
+    def forward(self, x, time, timesteps=None):
+        """
+        `timesteps` optionally gives the integer timestep of each sample as a
+        python sequence; when they were registered with cache_timesteps the
+        cached embeddings are used instead of `time`.
+        """
+        cached = self._lookup_time_cache(timesteps) if timesteps is not None else None
+        if cached is None:
+            return self._forward(x, self.time_embedding(time))
+
+        time_embed, emb_outs, blocks = cached
+        for block, emb_out in zip(blocks, emb_outs):
+            block.cached_emb_out = emb_out
+        try:
+            return self._forward(x, time_embed)
+        finally:
+            for block in blocks:
+                block.cached_emb_out = None
+
+    def _forward(self, x, time_embed):
         skips = []
 
         h = x.type(self.dtype)
@@ -3,6 +3,8 @@ import torch.nn.functional as F
 import matplotlib.pyplot as plt
 import numpy as np
 import math
+import os
+from contextlib import nullcontext
 
 def sigmoid(x):
     return 1 / (1 + np.exp(-x))
@@ -72,24 +74,184 @@ def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
         betas.append(min(1 - alpha_bar(t2) / alpha_bar(t1), max_beta))
     return np.array(betas)
 
-def get_index_from_list(vals, t, x_shape, config):
-    """ 
-    Returns a specific index t of a passed list of values vals
-    while considering the batch dimension.
-    """
-    batch_size = t.shape[0]
-    out = vals.gather(-1, t.cpu())
-    return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(t.device)
-
-def compute_alpha(beta, t, config):
-    beta = torch.cat([torch.zeros(1).to(beta.device), beta], dim=0)
-    beta = beta.to(config.model.device)
-    a = (1 - beta).cumprod(dim=0).index_select(0, t + 1).view(-1, 1, 1, 1)
-    return a
-
-def compute_alpha2(beta, t, config):
-    beta = torch.cat([torch.zeros(1).to(beta.device), beta], dim=0)
-    beta = beta.to(config.model.device)
-    t = t.to(config.model.device).long()
-    a = (1 - beta).cumprod(dim=0).index_select(0, t+1).view(-1, 1, 1, 1)
-    return a
\ No newline at end of file
+class DiffusionSchedule:
+    """
+    Precomputed diffusion schedule that lives on the compute device.
+    All terms are served by direct indexing with the timestep t; alpha_bar
+    additionally accepts t = -1, which maps to alpha_bar = 1 (the clean sample).
+    """
+
+    def __init__(self, betas, device="cpu"):
+        betas = torch.as_tensor(betas, dtype=torch.float).to(device)
+        self.device = torch.device(device)
+        self.betas = betas
+        self.alphas = 1. - betas
+        self.alphas_cumprod = torch.cumprod(self.alphas, dim=0)
+        self.alphas_cumprod_prev = F.pad(self.alphas_cumprod[:-1], (1, 0), value=1.0)
+        self.sqrt_recip_alphas = torch.sqrt(1.0 / self.alphas)
+        self.sqrt_alphas_cumprod = torch.sqrt(self.alphas_cumprod)
+        self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - self.alphas_cumprod)
+        self.posterior_variance = betas * (1. - self.alphas_cumprod_prev) / (1. - self.alphas_cumprod)
+        # shifted by one so that index t + 1 is valid for t = -1
+        self.alphas_cumprod_padded = F.pad(self.alphas_cumprod, (1, 0), value=1.0)
+
+    def __len__(self):
+        return self.betas.shape[0]
+
+    def _index(self, t):
+        if isinstance(t, torch.Tensor):
+            return t.to(self.device, non_blocking=True).long().reshape(-1)
+        return torch.as_tensor(t, device=self.device).long().reshape(-1)
+
+    def alpha_bar(self, t, ndim=4):
+        """
+        Cumulative alpha for timestep(s) t, shaped [N, 1, ..., 1] for broadcasting.
+        """
+        a = self.alphas_cumprod_padded.index_select(0, self._index(t) + 1)
+        return a.view(-1, *((1,) * (ndim - 1)))
+
+    def extract(self, name, t, x_shape):
+        """
+        Returns entry t of the precomputed term `name` while considering the
+        batch dimension of x_shape.
+        """
+        vals = getattr(self, name)
+        out = vals.index_select(0, self._index(t))
+        return out.view(-1, *((1,) * (len(x_shape) - 1)))
+
+    def to(self, device):
+        return DiffusionSchedule(self.betas, device)
+
+
+def get_schedule(constants_dict, config, betas=None):
+    """
+    Returns the DiffusionSchedule stored in constants_dict, building and
+    caching one on config.model.device if it is missing.
+    """
+    schedule = constants_dict.get('schedule')
+    if schedule is None:
+        schedule = DiffusionSchedule(constants_dict['betas'] if betas is None else betas, config.model.device)
+        constants_dict['schedule'] = schedule
+    elif schedule.device != torch.device(config.model.device):
+        schedule = schedule.to(config.model.device)
+        constants_dict['schedule'] = schedule
+    return schedule
+
+
+def enable_compile_cache(config):
+    """
+    Points the inductor caches at config.model.compile_cache_dir so compiled
+    kernels and FX graphs are reused across process starts.
+    """
+    cache_dir = getattr(config.model, 'compile_cache_dir', None)
+    if not cache_dir:
+        return
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        if hasattr(inductor_config, "fx_graph_cache"):
+            inductor_config.fx_graph_cache = True
+    except ImportError:
+        pass
+
+
+def compile_unet(unet, config):
+    """
+    Compiles UNetModel.forward with torch.compile when config.model.compile is
+    set. The latent size is fixed at inference but step size buckets vary the
+    batch size, so dynamic=None recompiles once with a dynamic batch dimension
+    instead of once per size; the inductor backend also runs on CPU.
+    """
+    if not getattr(config.model, 'compile', False):
+        return unet
+    enable_compile_cache(config)
+    return torch.compile(
+        unet,
+        backend=getattr(config.model, 'compile_backend', 'inductor'),
+        mode=getattr(config.model, 'compile_mode', None),
+        dynamic=None,
+    )
+
+
+def use_channels_last(config):
+    return bool(getattr(config.model, 'channels_last', False))
+
+
+def to_channels_last(x, config):
+    """
+    Converts a module or a 4-D tensor to torch.channels_last (NHWC) when
+    config.model.channels_last is set, so oneDNN / cuDNN select their NHWC
+    convolution kernels. Anything else is returned unchanged.
+    """
+    if not use_channels_last(config):
+        return x
+    if isinstance(x, torch.nn.Module):
+        return x.to(memory_format=torch.channels_last)
+    if isinstance(x, torch.Tensor) and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def tile_positions(length, tile, overlap):
+    """Tile offsets along one axis; the last tile is aligned to the border"""
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+def blend_window(tile, overlap, device):
+    """[1, 1, tile, tile] weights ramping linearly over the overlap, never zero"""
+    ramp = torch.ones(tile, device=device)
+    if overlap > 0:
+        edge = torch.linspace(0, 1, overlap + 2, device=device)[1:-1]
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge.flip(0)
+    return (ramp[:, None] * ramp[None, :]).view(1, 1, tile, tile)
+
+
+def round_step_size(x, n=10):
+    res = np.ceil(x/n)*n
+    mask = np.logical_and(x % n < n/2, x % n > 0)
+    res[mask] -= n
+    return res
+
+
+def steps_from_bins(bin_ids, config):
+    """(step_size, skip) arrays for KNN histogram bins, as validate uses them"""
+    step_size = round_step_size(np.maximum(bin_ids, 2) / 10 * config.model.test_trajectoy_steps)
+    skip = np.maximum(step_size / getattr(config.model, 'dynamic_num_steps', 10), 1).astype(int)
+    return step_size, skip
+
+
+INFERENCE_DTYPES = {
+    'float32': torch.float32,
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+}
+
+
+def get_inference_dtype(config):
+    """
+    Returns the torch dtype selected by config.model.inference_dtype (default float32).
+    """
+    name = getattr(config.model, 'inference_dtype', 'float32')
+    if name not in INFERENCE_DTYPES:
+        raise ValueError(f"unsupported inference dtype: {name}, choose from {list(INFERENCE_DTYPES)}")
+    return INFERENCE_DTYPES[name]
+
+
+def inference_autocast(config):
+    """
+    Autocast context for the VAE and the feature extractor in reduced precision
+    inference. Autocast keeps softmax and normalization layers in float32; a
+    no-op for float32.
+    """
+    dtype = get_inference_dtype(config)
+    if dtype == torch.float32:
+        return nullcontext()
+    device_type = str(config.model.device).split(':')[0]
+    return torch.autocast(device_type=device_type, dtype=dtype)